@@ -1,120 +1,175 @@
-from mesa import Agent
-import math
+from collections.abc import Mapping
+from pharmacodynamics import DRUGS, DRUG_BITS
+from lineage import ROOT_CLONE
 
-class MtbBacterium(Agent):
-    def __init__(self, model, resistance_profile=None, initial_is_persister=False):
-        self.model = model
 
-        if resistance_profile:
-            self.resistance_profile = resistance_profile.copy()
-        else:
-            self.resistance_profile = {
-                "RIF": False,
-                "INH": False,
-                "PZA": False,
-                "EMB": False
-            }
+def profile_to_mask(resistance_profile):
+    mask = 0
+    for drug, is_resistant in resistance_profile.items():
+        if is_resistant:
+            mask |= DRUG_BITS[drug]
+    return mask
 
-        self.is_persister = initial_is_persister
-        if self.is_persister:
-            self.replicating = False
-        else:
-            self.replicating = True
 
-        self.pos = None
+def mask_to_drugs(resistance_mask):
+    return tuple(drug for drug in DRUGS if resistance_mask & DRUG_BITS[drug])
 
-    def _get_effective_kill_rate(self, drug_name_upper):
-        model = self.model
-        drug_name_lower = drug_name_upper.lower()
 
-        k_max_daily_drug_effect = getattr(model, f"{drug_name_lower}_k_max_kill_daily")
-        ec50_ng_ml = getattr(model, f"{drug_name_lower}_ec50_ng_ml")
-        hill_coefficient = getattr(model, f"{drug_name_lower}_hill_coefficient")
-        drug_concentration_ng_ml = getattr(model, f"{drug_name_lower}_active_concentration_ng_ml")
+class ResistanceProfileView(Mapping):
+    # Read-only {"RIF": bool, ...} view over a resistance bitmask, for callers
+    # written against the old per-agent dict.
+    __slots__ = ("_mask",)
 
-        conc_pow_hill = math.pow(drug_concentration_ng_ml, hill_coefficient)
-        ec50_pow_hill = math.pow(ec50_ng_ml, hill_coefficient)
+    def __init__(self, resistance_mask):
+        self._mask = resistance_mask
 
-        if (ec50_pow_hill + conc_pow_hill) == 0:
-            effective_kill_rate = 0.0
-        else:
-            effective_kill_rate = k_max_daily_drug_effect * (conc_pow_hill / (ec50_pow_hill + conc_pow_hill))
+    def __getitem__(self, drug):
+        return bool(self._mask & DRUG_BITS[drug])
 
-        return effective_kill_rate
+    def __iter__(self):
+        return iter(DRUGS)
 
-    def step(self):
+    def __len__(self):
+        return len(DRUGS)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class MtbBacterium:
+    # Not a mesa.Agent subclass: Agent has no __slots__, so every instance would
+    # still carry a __dict__. SingleGrid and AgentSet only need pos and weakrefs.
+    __slots__ = ("model", "pos", "is_persister", "resistance_mask", "clone", "__weakref__")
+
+    def __init__(self, model, resistance_profile=None, initial_is_persister=False, resistance_mask=0,
+                 clone=ROOT_CLONE):
+        self.model = model
+        self.clone = clone
+
+        if resistance_profile:
+            resistance_mask |= profile_to_mask(resistance_profile)
+        self.resistance_mask = resistance_mask
+
+        self.is_persister = initial_is_persister
+        self.pos = None
+
+    @property
+    def replicating(self):
+        return not self.is_persister
+
+    @property
+    def resistance_profile(self):
+        return ResistanceProfileView(self.resistance_mask)
+
+    def switch_phenotype(self):
+        # Returns True if the bacterium switched between persister and replicating.
         model = self.model
 
         if not self.is_persister:
             is_any_drug_active_in_model = model.rif_drug_on or model.inh_drug_on or model.pza_drug_on or model.emb_drug_on
-            if is_any_drug_active_in_model and self.model.random.random() < model.prob_susceptible_to_persister:
+            if is_any_drug_active_in_model and model.random_stream.random() < model.prob_susceptible_to_persister:
                 self.is_persister = True
-                self.replicating = False
+                model.counts.switch(self.resistance_mask, True)
+                return True
         else:
             is_any_drug_active_in_model = model.rif_drug_on or model.inh_drug_on or model.pza_drug_on or model.emb_drug_on
-            if (not is_any_drug_active_in_model and self.model.random.random() < model.prob_persister_to_susceptible_no_drug) or \
-               (is_any_drug_active_in_model and self.model.random.random() < model.prob_persister_to_susceptible_drug_on):
+            if (not is_any_drug_active_in_model and model.random_stream.random() < model.prob_persister_to_susceptible_no_drug) or \
+               (is_any_drug_active_in_model and model.random_stream.random() < model.prob_persister_to_susceptible_drug_on):
                 self.is_persister = False
-                self.replicating = True
-
-        max_effective_rate_today = 0.0
-        active_drugs_susceptible_to = []
-
-        if model.rif_drug_on and not self.resistance_profile["RIF"] and self.replicating:
-            active_drugs_susceptible_to.append("RIF")
-        if model.inh_drug_on and not self.resistance_profile["INH"] and self.replicating:
-            active_drugs_susceptible_to.append("INH")
-        if model.pza_drug_on and not self.resistance_profile["PZA"] and self.replicating:
-            active_drugs_susceptible_to.append("PZA")
-        if model.emb_drug_on and not self.resistance_profile["EMB"] and self.replicating:
-            active_drugs_susceptible_to.append("EMB")
-
-        if active_drugs_susceptible_to:
-            for drug_name in active_drugs_susceptible_to:
-                current_drug_rate = self._get_effective_kill_rate(drug_name)
-                if current_drug_rate > max_effective_rate_today:
-                    max_effective_rate_today = current_drug_rate
-            final_kill_probability_today = 1.0 - math.exp(-max_effective_rate_today)
+                model.counts.switch(self.resistance_mask, False)
+                return True
+        return False
+
+    def is_killed(self):
+        model = self.model
+
+        if not self.is_persister and model.active_drug_mask:
+            final_kill_probability_today = model.kill_probability_today[self.resistance_mask]
         else:
             final_kill_probability_today = 0.0
 
-        final_kill_probability_today = max(0.0, min(final_kill_probability_today, 1.0))
+        return model.random_stream.random() < final_kill_probability_today
+
+    def spawn_child(self):
+        # Returns (child, position) for a child ready to be placed, or None.
+        model = self.model
 
-        if self.model.random.random() < final_kill_probability_today:
+        # Interior bacteria (no empty Moore neighbour) cannot place a child, so they skip
+        # the replication draw, mutation sampling, child construction and the neighbourhood scan.
+        if not self.is_persister and self.pos in model.grid.frontier and \
+           model.random_stream.random() < model.replication_prob_per_day:
+            child_resistance_mask = model.mutation_sampler.sample(self.resistance_mask)
+            clone = self.clone
+            if child_resistance_mask != self.resistance_mask and model.lineage is not None:
+                clone = model.lineage.record(self.clone, self.resistance_mask, child_resistance_mask, model.steps)
+
+            child = MtbBacterium(model=model, resistance_mask=child_resistance_mask, initial_is_persister=False,
+                                 clone=clone)
+
+            neighborhood = self.model.grid.get_neighborhood(
+                self.pos,
+                moore=True,
+                include_center=False
+            )
+            empty_neighbors = [cell for cell in neighborhood if self.model.grid.is_cell_empty(cell)]
+
+            return child, empty_neighbors[int(model.random_stream.random() * len(empty_neighbors))]
+        return None
+
+    def add_child(self, child, new_pos):
+        self.model.grid.place_agent(child, new_pos)
+        child.pos = new_pos
+        self.model.agents.add(child)
+        self.model.counts.add(child.resistance_mask, False)
+
+    def step(self):
+        # switch_phenotype, is_killed, spawn_child and add_child inlined: this runs once per
+        # bacterium per day, and the method calls cost several percent of a step. Keep the
+        # draws in step with those methods, which profiled_agent_step uses instead.
+        model = self.model
+        random = model.random_stream.random
+        drug_on = model.rif_drug_on or model.inh_drug_on or model.pza_drug_on or model.emb_drug_on
+
+        if not self.is_persister:
+            if drug_on and random() < model.prob_susceptible_to_persister:
+                self.is_persister = True
+                model.counts.switch(self.resistance_mask, True)
+        elif (not drug_on and random() < model.prob_persister_to_susceptible_no_drug) or \
+             (drug_on and random() < model.prob_persister_to_susceptible_drug_on):
+            self.is_persister = False
+            model.counts.switch(self.resistance_mask, False)
+
+        if not self.is_persister and model.active_drug_mask:
+            final_kill_probability_today = model.kill_probability_today[self.resistance_mask]
+        else:
+            final_kill_probability_today = 0.0
+        if random() < final_kill_probability_today:
             self.remove()
             return
 
-        if self.replicating and not self.is_persister and self.model.random.random() < model.replication_prob_per_day:
-            child_resistance_profile = self.resistance_profile.copy()
-
-            if not self.resistance_profile["RIF"] and self.model.random.random() < model.rif_mutation_rate:
-                child_resistance_profile["RIF"] = True
-            if not self.resistance_profile["INH"] and self.model.random.random() < model.inh_mutation_rate:
-                child_resistance_profile["INH"] = True
-            if not self.resistance_profile["PZA"] and self.model.random.random() < model.pza_mutation_rate:
-                child_resistance_profile["PZA"] = True
-            if not self.resistance_profile["EMB"] and self.model.random.random() < model.emb_mutation_rate:
-                child_resistance_profile["EMB"] = True
-
-            child = MtbBacterium(model=model, resistance_profile=child_resistance_profile, initial_is_persister=False)
-
-            if self.pos:
-                neighborhood = self.model.grid.get_neighborhood(
-                    self.pos,
-                    moore=True,
-                    include_center=False
-                )
-                empty_neighbors = [cell for cell in neighborhood if self.model.grid.is_cell_empty(cell)]
-
-                if empty_neighbors:
-                    new_pos = self.model.random.choice(empty_neighbors)
-                    self.model.grid.place_agent(child, new_pos)
-                    child.pos = new_pos
-                    self.model.agents.add(child)
+        grid = model.grid
+        if not self.is_persister and self.pos in grid.frontier and random() < model.replication_prob_per_day:
+            child_resistance_mask = model.mutation_sampler.sample(self.resistance_mask)
+            clone = self.clone
+            if child_resistance_mask != self.resistance_mask and model.lineage is not None:
+                clone = model.lineage.record(self.clone, self.resistance_mask, child_resistance_mask, model.steps)
+
+            child = MtbBacterium(model=model, resistance_mask=child_resistance_mask, initial_is_persister=False,
+                                 clone=clone)
+
+            neighborhood = grid.get_neighborhood(self.pos, moore=True, include_center=False)
+            empty_neighbors = [cell for cell in neighborhood if grid.is_cell_empty(cell)]
+            new_pos = empty_neighbors[int(random() * len(empty_neighbors))]
+
+            grid.place_agent(child, new_pos)
+            child.pos = new_pos
+            model.agents.add(child)
+            model.counts.add(child_resistance_mask, False)
 
     def remove(self):
         if self.pos:
              self.model.grid.remove_agent(self)
              self.pos = None
         if self in self.model.agents:
-             self.model.agents.remove(self)
\ No newline at end of file
+             self.model.agents.remove(self)
+             self.model.counts.remove(self.resistance_mask, self.is_persister)
\ No newline at end of file
@@ -1,8 +1,13 @@
-from model import MtbResistanceModel
-from mesa.experimental.devs import ABMSimulator
-from agents import MtbBacterium
+from agents import mask_to_drugs
+from counters import N_PATTERNS, PopulationCounts, pattern_key
+from result_cache import ResultCache, model_result, result_key
+from fast_forward import DEFAULT_BLOCK_SIZE
+from history import HistoryRecorder
 from collections import defaultdict
+import numpy as np
 import argparse
+import json
+import csv
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Mtb Simulation')
@@ -10,11 +15,24 @@ def parse_arguments():
     parser.add_argument('--start', type=int,
                         help='Start value')
     
-    parser.add_argument('--interval', type=int, default=1,
+    parser.add_argument('--interval', type=int, default=None,
                         help='Interval value (default: 1)')
     
-    parser.add_argument('--drug-type',type=str, default="RIF PZA INH EMB",
+    parser.add_argument('--drug-type',type=str, default=None,
                         help='Drug types (default: RIF PZA INH EMB)')
+
+    parser.add_argument('--pk', action='store_true',
+                        help='Time-varying drug concentrations from dose absorption/elimination instead of on/off days')
+
+    parser.add_argument('--adherence', type=float, default=1.0,
+                        help='With --pk, long-run fraction of scheduled doses taken (default: 1.0)')
+
+    parser.add_argument('--miss-persistence', type=float, default=None,
+                        help='With --pk, probability that a missed dose is followed by another miss '
+                             '(default: misses are independent)')
+
+    parser.add_argument('--missed-doses', type=int, nargs='+', default=[],
+                        help='With --pk, days whose scheduled dose is always missed')
     
     parser.add_argument('--days', type=int,
                         help='Number of days')
@@ -30,62 +48,144 @@ def parse_arguments():
     parser.add_argument('--height', type=int, default=250,
                         help='Height')
 
-    return parser.parse_args()
-
-args = parse_arguments()
-start = args.start
-interval = args.interval
-drug_type = args.drug_type
-days = args.days
-seed = args.seed
-initial = args.initial
-width = args.width
-height = args.height
-
-def get_resistance_pattern(agent):
-    resistant_drugs = []
-    drugs = ["RIF", "INH", "PZA", "EMB"]
-    
-    for drug in drugs:
-        if agent.resistance_profile.get(drug, False):
-            resistant_drugs.append(drug)
-    
-    return tuple(resistant_drugs) if resistant_drugs else ("Susceptible",)
+    parser.add_argument('--engine', type=str, default="agent", choices=["agent", "numpy", "tiled"],
+                        help='Simulation engine (default: agent)')
 
-def get_agent_classification(agent):
-    resistance_pattern = get_resistance_pattern(agent)
-    is_persister = getattr(agent, 'is_persister', False)
-    
-    if resistance_pattern == ("Susceptible",):
-        base_type = "Susceptible"
-    else:
-        base_type = " + ".join(resistance_pattern)
-    
-    if is_persister:
-        return f"{base_type} (Persister)"
-    else:
-        return base_type
+    parser.add_argument('--tiles', type=int, default=4,
+                        help='Tiles per grid side for the tiled engine (default: 4)')
+
+    parser.add_argument('--workers', type=int, default=0,
+                        help='Worker processes stepping the tiles of the tiled engine; 0 steps them in this process (default: 0)')
+
+    parser.add_argument('--seeding', type=str, default="uniform", choices=["uniform", "focus", "foci"],
+                        help='Initial seeding layout (default: uniform)')
+
+    parser.add_argument('--foci', type=int, default=3,
+                        help='Number of foci for the foci seeding layout (default: 3)')
+
+    parser.add_argument('--focus-radius', type=float, default=None,
+                        help='Spread of each seeding focus in cells (default: sized to the inoculum)')
+
+    parser.add_argument('--checkpoint', type=str, default=None,
+                        help='Snapshot file written every --checkpoint-every days and at the end')
+
+    parser.add_argument('--checkpoint-every', type=int, default=10,
+                        help='Days between checkpoints (default: 10)')
+
+    parser.add_argument('--resume', type=str, default=None,
+                        help='Continue from a snapshot up to --days; --start/--interval/--drug-type, '
+                             'if given, fork it into a different regimen')
 
-def count_all_patterns(agents):
+    parser.add_argument('--report-every', type=int, default=1,
+                        help='Report every N days; the last day is always reported (default: 1)')
+
+    parser.add_argument('--quiet', action='store_true',
+                        help='Only print the start line and the final summary')
+
+    parser.add_argument('--output', type=str, default=None,
+                        help='Stream one record per reported day to this file')
+
+    parser.add_argument('--format', type=str, default=None, choices=["csv", "jsonl"],
+                        help='Format for --output (default: from the file extension, else csv)')
+
+    parser.add_argument('--history', type=str, default=None,
+                        help='Record the grid state of every day to this compressed history file')
+
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Result cache directory; a run already in it is not simulated again '
+                             '(not used with --checkpoint, --history, --output or --profile)')
+
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='Cache size limit in MB; least recently used results are evicted (default: 256)')
+
+    parser.add_argument('--profile', action='store_true',
+                        help='Time each phase of the model step and print a breakdown at the end')
+
+    parser.add_argument('--lineage', action='store_true',
+                        help='Track resistant clone lineages and print their origins at the end')
+
+    parser.add_argument('--fast-forward', action='store_true',
+                        help='Run the untreated days before --start on per-block counts instead of bacteria')
+
+    parser.add_argument('--fast-forward-block', type=int, default=DEFAULT_BLOCK_SIZE,
+                        help=f'Block side, in cells, for --fast-forward (default: {DEFAULT_BLOCK_SIZE}; '
+                             'the growth estimate is only calibrated for the default)')
+
+    args = parser.parse_args()
+    # These runs are never read from or stored in the result cache.
+    uncached = [flag for flag, value in (("--checkpoint", args.checkpoint), ("--history", args.history),
+                                         ("--output", args.output), ("--profile", args.profile),
+                                         ("--lineage", args.lineage)) if value]
+    if args.cache and uncached:
+        parser.error(f"--cache cannot be combined with {', '.join(uncached)}: such runs are not cached")
+    if args.cache and args.resume and snapshot_has_lineage(args.resume):
+        parser.error(f"--cache cannot be combined with --resume of {args.resume}: it tracks lineage, "
+                     "which cached results do not keep")
+    return args
+
+def snapshot_has_lineage(path):
+    # Reads only the metadata of a MtbResistanceModel.save_snapshot file; a missing or
+    # unreadable file is left for load_snapshot to report.
+    try:
+        with np.load(path) as data:
+            return bool(json.loads(str(data["metadata"])).get("lineage", False))
+    except (OSError, ValueError, KeyError):
+        return False
+
+def classification_label(resistance_mask, is_persister):
+    resistant_drugs = mask_to_drugs(resistance_mask)
+    base_type = " + ".join(resistant_drugs) if resistant_drugs else "Susceptible"
+    return f"{base_type} (Persister)" if is_persister else base_type
+
+# Every (resistance mask, persister) class in PopulationCounts key order, e.g. "RIF + INH (Persister)".
+CLASSIFICATION_LABELS = [classification_label(key >> 1, key & 1) for key in range(N_PATTERNS)]
+
+def count_histogram_patterns(counts):
     resistance_counts = defaultdict(int)
     full_counts = defaultdict(int)
     persister_counts = {"Persisters": 0, "Non-Persisters": 0}
-    
-    for agent in agents:
-        if isinstance(agent, MtbBacterium):
-            resistance_pattern = get_resistance_pattern(agent)
-            resistance_counts[resistance_pattern] += 1
-            
-            full_classification = get_agent_classification(agent)
-            full_counts[full_classification] += 1
-            
-            if agent.is_persister:
-                persister_counts["Persisters"] += 1
-            else:
-                persister_counts["Non-Persisters"] += 1
-    
+
+    for (resistance_mask, is_persister), count in counts.items():
+        resistant_drugs = mask_to_drugs(resistance_mask)
+        resistance_counts[resistant_drugs if resistant_drugs else ("Susceptible",)] += count
+        full_counts[CLASSIFICATION_LABELS[pattern_key(resistance_mask, is_persister)]] += count
+        persister_counts["Persisters" if is_persister else "Non-Persisters"] += count
+
     return resistance_counts, full_counts, persister_counts
 
+def count_model_patterns(model):
+    # Reads the model's live (resistance mask, persister) histogram instead of walking agents.
+    return count_histogram_patterns(model.counts)
+
+class ReportWriter:
+    # Streams one record per reported day. csv has a fixed column per reporter and per
+    # classification; jsonl lists only the non-empty classifications.
+    def __init__(self, path, output_format):
+        self.file = open(path, "w", newline="")
+        self.output_format = output_format
+        self.csv_writer = None
+
+    def write(self, model):
+        record = {"day": model.steps}
+        for name, values in model.datacollector.model_vars.items():
+            record[name] = values[-1]
+
+        if self.output_format == "jsonl":
+            record["patterns"] = {CLASSIFICATION_LABELS[pattern_key(mask, is_persister)]: count
+                                  for (mask, is_persister), count in model.counts.items()}
+            self.file.write(json.dumps(record) + "\n")
+        else:
+            for label, count in zip(CLASSIFICATION_LABELS, model.counts.histogram):
+                record[label] = count
+            if self.csv_writer is None:
+                self.csv_writer = csv.DictWriter(self.file, fieldnames=list(record))
+                self.csv_writer.writeheader()
+            self.csv_writer.writerow(record)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
 def print_detailed_summary(resistance_counts, full_counts, persister_counts, total_count, day):
     print(f"Day {day}: Total Mtb = {total_count}")
     if not resistance_counts:
@@ -114,37 +214,170 @@ def print_detailed_summary(resistance_counts, full_counts, persister_counts, tot
     for classification, count in sorted_full:
         print(f"    {classification}: {count}")
 
-model = MtbResistanceModel(
-    seed=int(seed),
-    day_start= start,
-    day_interval=interval,
-    drug_type= drug_type,
-    initial_mtb=initial,
-    width=width,
-    height=height,
-    simulator=ABMSimulator(),
-)
-
-print(f"Starting simulation. Treatment from day {model.day_start_treatment}, interval {model.day_treatment_interval} day(s).")
-print(f"Active drugs initially configured: {model.active_drugs_config}")
-print(f"Initial Mtb count: {len(model.agents)}")
-print("=" * 60)
-
-for i in range(days):
-    model.step()
-    
-    resistance_counts, full_counts, persister_counts = count_all_patterns(model.agents)
-    total_mtb_count = len(model.agents)
-    
-    print_detailed_summary(resistance_counts, full_counts, persister_counts, total_mtb_count, i+1)
-    print("-" * 60)
+def print_final_summary(counts, days):
+    final_resistance_counts, final_full_counts, final_persister_counts = count_histogram_patterns(counts)
+    final_total_count = sum(final_persister_counts.values())
+
+    print("=" * 60)
+    print("FINAL COMPREHENSIVE SUMMARY")
+    print("=" * 60)
+    print_detailed_summary(final_resistance_counts, final_full_counts, final_persister_counts, final_total_count, days)
+
+def print_lineage_summary(lineage):
+    # Per resistance pattern that ever arose: independent origins, first origin day and
+    # the clones of it alive at the end.
+    clones = lineage.clones()
+    alive = np.isin(clones["clone"], lineage.live)
+    print("=" * 60)
+    print("CLONE LINEAGE SUMMARY")
+    print("=" * 60)
+    for mask, origins in enumerate(lineage.origin_counts().tolist()):
+        if mask == 0 or origins == 0:
+            continue
+        surviving = int(np.count_nonzero(alive & (clones["mask"] == mask)))
+        print(f"{classification_label(mask, False)}: {origins} origin(s), first on day {lineage.time_to_origin(mask)}, "
+              f"{surviving} clone(s) alive")
+
+def main():
+    args = parse_arguments()
+
+    # Imported after argument parsing: Mesa pulls in pandas, scipy and networkx, which
+    # --help and argument errors should not wait for.
+    from model import MtbResistanceModel
+
+    start = args.start
+    interval = args.interval
+    drug_type = args.drug_type
+    days = args.days
+    seed = args.seed
+    initial = args.initial
+    width = args.width
+    height = args.height
+    engine = args.engine
+    tiles = args.tiles
+    workers = args.workers
+    seeding = args.seeding
+    foci = args.foci
+    focus_radius = args.focus_radius
+    checkpoint = args.checkpoint
+    checkpoint_every = args.checkpoint_every
+    resume = args.resume
+    profile = args.profile
+    report_every = max(1, args.report_every)
+    quiet = args.quiet
+    output = args.output
+    output_format = args.format or ("jsonl" if output and output.endswith(".jsonl") else "csv")
+    history = args.history
+    lineage = args.lineage
+    cache_dir = args.cache
+
+    if resume:
+        model = MtbResistanceModel.load_snapshot(
+            resume,
+            workers=workers,
+            drug_type=drug_type,
+            day_start=start,
+            day_interval=interval,
+        )
+        print(f"Resumed from {resume} at day {model.steps}.")
+    else:
+        model = MtbResistanceModel(
+            seed=int(seed),
+            day_start= start,
+            day_interval=interval if interval is not None else 1,
+            drug_type= drug_type if drug_type is not None else "RIF PZA INH EMB",
+            initial_mtb=initial,
+            width=width,
+            height=height,
+            engine=engine,
+            tiles=tiles,
+            workers=workers,
+            seeding=seeding,
+            n_foci=foci,
+            focus_radius=focus_radius,
+            pk=args.pk,
+            adherence=args.adherence,
+            miss_persistence=args.miss_persistence,
+            missed_doses=args.missed_doses,
+            lineage=lineage,
+            fast_forward=args.fast_forward,
+            fast_forward_block=args.fast_forward_block,
+        )
+
+    if profile:
+        model.enable_profiling()
+
+    print(f"Starting simulation. Treatment from day {model.day_start_treatment}, interval {model.day_treatment_interval} day(s).")
+    print(f"Active drugs initially configured: {model.active_drugs_config}")
+    print(f"Initial Mtb count: {model.datacollector.model_vars['Total Mtb'][-1]}")
+    print("=" * 60)
+
+    cache = cache_key = None
+    if cache_dir and model.seed is not None:
+        cache = ResultCache(cache_dir, max_bytes=args.cache_size * 2**20)
+        cache_key = result_key(model, days)
+        cached = cache.get(cache_key)
+        if cached is not None:
+            print(f"Cache hit: {days} days loaded from {cache_dir}.")
+            print_final_summary(PopulationCounts(cached["histogram"]), days)
+            return
+
+    writer = ReportWriter(output, output_format) if output else None
+    recorder = None
+    if history:
+        recorder = HistoryRecorder(history, model.width, model.height, metadata={
+            "seed": model.seed,
+            "engine": model.engine,
+            "drugs": [drug for drug, active in model.active_drugs_config.items() if active],
+            "day_start": model.day_start_treatment,
+            "day_interval": model.day_treatment_interval,
+        })
+        recorder.record(model)
+
+    # Closing writes the history footer index and flushes the report, so it must also
+    # happen when the run crashes or is interrupted.
+    try:
+        for i in range(model.steps, days):
+            model.step()
+            if recorder:
+                recorder.record(model)
+
+            if (i + 1) % report_every == 0 or i + 1 == days:
+                if writer:
+                    writer.write(model)
+
+                if not quiet:
+                    resistance_counts, full_counts, persister_counts = count_model_patterns(model)
+                    total_mtb_count = sum(persister_counts.values())
+
+                    print_detailed_summary(resistance_counts, full_counts, persister_counts, total_mtb_count, i+1)
+                    print("-" * 60)
+
+            if checkpoint and (i + 1) % checkpoint_every == 0:
+                model.save_snapshot(checkpoint)
+
+        if checkpoint:
+            model.save_snapshot(checkpoint)
+    finally:
+        if writer:
+            writer.close()
+        if recorder:
+            recorder.close()
+
+    if cache:
+        cache.put(cache_key, model_result(model))
+
+    print(f"\nSimulation complete after {days} days.")
+
+    print_final_summary(model.counts, days)
+
+    if model.lineage is not None:
+        print_lineage_summary(model.lineage)
 
-print(f"\nSimulation complete after {days} days.")
+    if profile:
+        print("=" * 60)
+        print(model.profiler.report())
 
-final_resistance_counts, final_full_counts, final_persister_counts = count_all_patterns(model.agents)
-final_total_count = len(model.agents)
 
-print("=" * 60)
-print("FINAL COMPREHENSIVE SUMMARY")
-print("=" * 60)
-print_detailed_summary(final_resistance_counts, final_full_counts, final_persister_counts, final_total_count, days)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,21 @@
 from mesa.experimental.devs import ABMSimulator
+from mesa.visualization.utils import update_counter
+from matplotlib.figure import Figure
 from agents import MtbBacterium
 from model import MtbResistanceModel
+from background import BackgroundRunner
+from raster import RASTER_COLORS, RasterState, downsample_categories, frame_categories
+from history import HistoryReader
+from matplotlib.colors import ListedColormap
+from mesa.visualization.solara_viz import UserInputs
+import threading
+import solara
 
 from mesa.visualization import (
     CommandConsole,
     Slider,
     SolaraViz,
     make_plot_component,
-    make_space_component,
 )
 
 
@@ -49,6 +57,39 @@ def mtb_potrayal(agent):
     return portrayal
 
 
+def make_raster_space_component(render_every=1, post_process=None):
+    # Draws the grid as one image instead of one scatter marker per bacterium, with the
+    # colours of mtb_potrayal. The image is only recomputed every render_every steps, and
+    # then only the cells that changed are repainted.
+    def MakeRasterSpace(model):
+        return RasterSpace(model, render_every=render_every, post_process=post_process)
+
+    return MakeRasterSpace
+
+
+@solara.component
+def RasterSpace(model, render_every=1, post_process=None):
+    update_counter.get()
+
+    raster = solara.use_memo(lambda: RasterState(model.width, model.height), dependencies=[model])
+
+    def build_figure():
+        fig = Figure()
+        ax = fig.add_subplot()
+        image = ax.imshow(raster.rgba, origin="lower", interpolation="nearest")
+        if post_process is not None:
+            post_process(ax)
+        return fig, image
+
+    fig, image = solara.use_memo(build_figure, dependencies=[raster])
+
+    if raster.step is None or model.steps < raster.step or model.steps - raster.step >= render_every:
+        raster.update(model)
+        image.set_data(raster.rgba)
+
+    solara.FigureMatplotlib(fig, format="png", bbox_inches="tight", dependencies=[model, raster.step])
+
+
 model_params = {
     "seed": {
         "type": "InputText",
@@ -75,6 +116,17 @@ model_params = {
         "value": "RIF",
         "label": "Drug type(s)",
     },
+    "seeding": {
+        "type": "Select",
+        "value": "uniform",
+        "values": ["uniform", "focus", "foci"],
+        "label": "Initial seeding layout",
+    },
+    "n_foci": {
+        "type": "InputText",
+        "value": 3,
+        "label": "Number of foci (foci layout)",
+    },
     "width": Slider("Grid Width", 250, 1, 500),
     "height": Slider("Grid Height", 250, 1, 500),
 }
@@ -85,46 +137,227 @@ def post_process_space(ax):
     ax.set_aspect("equal")
     ax.set_xticks([])
     ax.set_yticks([])
-    ax.figure.set_size_inches(25,25)
+    ax.figure.set_size_inches(8,8)
 
 def post_process_lines(ax):
     ax.legend(loc="center left", bbox_to_anchor=(1, 0.9))
     ax.figure.set_size_inches(5,2)
 
-mtb_susceptible = make_plot_component(
-    {
-        "Total Mtb": "#000000",
-        "Susceptible": "tab:red",
-     },
-    post_process=post_process_lines,
-)
+susceptible_series = {
+    "Total Mtb": "#000000",
+    "Susceptible": "tab:red",
+}
 
-mtb_resistant= make_plot_component(
-    {
-        "Persister": "#8B0000",
-        "Res-RIF": "#D4FF00",
-        "Res-INH": "#37FF00",
-        "Res-PZA": "#0044FF",
-        "Res-EMB": "#FF00D9",
-     },
-    post_process=post_process_lines,
-)
+resistant_series = {
+    "Persister": "#8B0000",
+    "Res-RIF": "#D4FF00",
+    "Res-INH": "#37FF00",
+    "Res-PZA": "#0044FF",
+    "Res-EMB": "#FF00D9",
+}
 
-space_component = make_space_component(
-    mtb_potrayal, draw_grid=False, post_process=post_process_space
-)
+mtb_susceptible = make_plot_component(susceptible_series, post_process=post_process_lines)
+
+mtb_resistant= make_plot_component(resistant_series, post_process=post_process_lines)
+
+# Mesa's make_space_component with mtb_potrayal draws the same picture with one marker per
+# bacterium, which is only usable on small grids.
+space_component = make_raster_space_component(render_every=1, post_process=post_process_space)
+
+
+runner_params = {
+    "days": {
+        "type": "InputText",
+        "value": 180,
+        "label": "Days to run",
+    },
+    "batch_size": Slider("Steps per batch", 1, 1, 50),
+    "max_fps": Slider("Max frames per second", 5, 1, 30),
+}
+
+
+def parse_input(value):
+    # InputText hands back strings; numbers are passed on to the model as numbers.
+    if isinstance(value, str):
+        for number_type in (int, float):
+            try:
+                return number_type(value)
+            except ValueError:
+                pass
+    return value
 
 
+def initial_values(params):
+    return {name: options.value if isinstance(options, Slider) else options["value"]
+            for name, options in params.items()}
+
+
+@solara.component
+def SnapshotSpace(snapshot):
+    fig = Figure()
+    ax = fig.add_subplot()
+    ax.imshow(snapshot["grid"], origin="lower", interpolation="nearest",
+              cmap=ListedColormap(RASTER_COLORS), vmin=0, vmax=len(RASTER_COLORS) - 1)
+    post_process_space(ax)
+    solara.FigureMatplotlib(fig, format="png", bbox_inches="tight", dependencies=[snapshot["version"]])
+
+
+@solara.component
+def SnapshotPlot(snapshot, series):
+    fig = Figure()
+    ax = fig.add_subplot()
+    rows = snapshot["rows"]
+    days = range(snapshot["first_row"], snapshot["first_row"] + len(rows))
+    for name, color in series.items():
+        ax.plot(days, [row[name] for row in rows], label=name, color=color)
+    post_process_lines(ax)
+    solara.FigureMatplotlib(fig, format="png", bbox_inches="tight", dependencies=[snapshot["version"]])
+
+
+@solara.component
+def BackgroundPage():
+    # Runs the model in a BackgroundRunner worker process; the page only draws the snapshots
+    # it publishes, so it stays responsive however long a step takes.
+    params = solara.use_reactive(initial_values(model_params))
+    settings = solara.use_reactive(initial_values(runner_params))
+    runner, set_runner = solara.use_state(None)
+    snapshot, set_snapshot = solara.use_state(None)
+
+    # Set after every render. A new snapshot is only handed over once the previous one has
+    # been drawn and the frame interval has passed, so a slow page skips snapshots instead
+    # of queueing renders.
+    rendered = solara.use_memo(threading.Event, dependencies=[runner])
+    solara.use_effect(rendered.set)
+
+    def watch_runner(cancel):
+        if runner is None:
+            return
+        version = 0
+        # Every row received so far, extended with only the new rows of each snapshot. It is
+        # only appended to after the previous snapshot was drawn.
+        rows, first_row = [], 0
+        while not cancel.is_set():
+            if not rendered.wait(0.5):
+                continue
+            cancel.wait(runner.min_interval)
+            latest = runner.wait_for_snapshot(version, timeout=0.5)
+            if latest is None:
+                continue
+            version = latest["version"]
+            if latest["first_row"] != first_row + len(rows):
+                # Snapshots were skipped; fetch the rows they carried.
+                start, missed = runner.rows_since(first_row + len(rows))
+                if start != first_row + len(rows):
+                    rows, first_row = [], start
+                rows.extend(missed)
+            else:
+                rows.extend(latest["rows"])
+            if runner.max_rows is not None and len(rows) > 2 * runner.max_rows:
+                dropped = len(rows) - runner.max_rows
+                del rows[:dropped]
+                first_row += dropped
+            rendered.clear()
+            set_snapshot({**latest, "rows": rows, "first_row": first_row})
+            if latest["state"] in ("finished", "cancelled", "failed"):
+                return
+
+    solara.use_thread(watch_runner, dependencies=[runner])
+
+    def start():
+        if runner is not None:
+            runner.cancel()
+        kwargs = {name: parse_input(value) for name, value in params.value.items()}
+        run_settings = {name: parse_input(value) for name, value in settings.value.items()}
+        new_runner = BackgroundRunner(kwargs, **run_settings)
+        new_runner.start()
+        set_snapshot(None)
+        set_runner(new_runner)
+
+    def cancel():
+        if runner is not None:
+            runner.cancel()
+
+    state = snapshot["state"] if snapshot else None
+    with solara.AppBar():
+        solara.AppBarTitle("Mtb Simulation")
+    with solara.Sidebar():
+        with solara.Card("Controls"):
+            with solara.Row():
+                solara.Button("Start", color="primary", on_click=start)
+                solara.Button("Pause", on_click=lambda: runner.pause(), disabled=state != "running")
+                solara.Button("Resume", on_click=lambda: runner.resume(), disabled=state != "paused")
+                solara.Button("Cancel", on_click=cancel, disabled=state not in ("running", "paused"))
+            if snapshot:
+                solara.Markdown(f"**Day {snapshot['step']}** ({state})")
+                if snapshot["error"] is not None:
+                    solara.Error(snapshot["error"])
+        with solara.Card("Run"):
+            UserInputs(runner_params, on_change=lambda name, value: settings.set({**settings.value, name: value}))
+        with solara.Card("Model Parameters"):
+            UserInputs(model_params, on_change=lambda name, value: params.set({**params.value, name: value}))
+
+    if snapshot is None or snapshot["grid"] is None:
+        solara.Info("Set the parameters and press Start." if runner is None else "Starting ...")
+        return
+    with solara.Columns([1, 2, 1]):
+        SnapshotPlot(snapshot, susceptible_series)
+        SnapshotSpace(snapshot)
+        SnapshotPlot(snapshot, resistant_series)
+
+
+@solara.component
+def ReplayPage():
+    # Scrubs through a history file recorded with `python app.py --history FILE`. The file
+    # is memory-mapped and only the chunk holding the selected day is decompressed.
+    path, set_path = solara.use_state("")
+    position, set_position = solara.use_state(0)
+
+    def open_history():
+        if not path:
+            return None
+        try:
+            return HistoryReader(path)
+        except (OSError, ValueError) as error:
+            return error
+
+    reader = solara.use_memo(open_history, dependencies=[path])
+
+    with solara.Sidebar():
+        with solara.Card("History"):
+            solara.InputText("History file", value=path, on_value=set_path)
+            if isinstance(reader, HistoryReader):
+                solara.SliderInt("Frame", value=min(position, len(reader) - 1), on_value=set_position,
+                                 min=0, max=len(reader) - 1)
+
+    if reader is None:
+        solara.Info("Enter the path of a history file.")
+        return
+    if not isinstance(reader, HistoryReader):
+        solara.Error(str(reader))
+        return
+
+    index = min(position, len(reader) - 1)
+    frame = reader[index]
+    snapshot = {"version": (path, index), "grid": downsample_categories(frame_categories(frame), 250)}
+    solara.Markdown(f"**Day {reader.steps[index]}**: {int((frame > 0).sum())} bacteria")
+    SnapshotSpace(snapshot)
+
+
+# The step-by-step SolaraViz page, which runs every step on the UI's request path.
 simulator = ABMSimulator()
 model = MtbResistanceModel(
     simulator = simulator,
     )
 
-page = SolaraViz(
+stepping_page = SolaraViz(
     model,
     components=[mtb_susceptible,space_component, mtb_resistant, CommandConsole],
     model_params=model_params,
     name="Mtb Simulation",
     simulator=simulator,
 )
+
+replay_page = ReplayPage()
+
+page = BackgroundPage()
 page  # noqa
@@ -0,0 +1,173 @@
+from raster import category_array, downsample_categories
+import multiprocessing
+import threading
+import time
+
+RUNNING, PAUSED, FINISHED, CANCELLED, FAILED = "running", "paused", "finished", "cancelled", "failed"
+
+
+def _run_model(model_params, days, batch_size, min_interval, max_grid_size, connection, resume, cancel):
+    # Worker process: builds the model and advances it batch_size steps at a time, sending
+    # (state, step, new reporter rows, grid, error) at most once per min_interval, whenever
+    # it pauses, and when it stops. The first row is the one the model collects on
+    # construction, so row i of the run is day i.
+    from model import MtbResistanceModel
+
+    model = None
+    rows = []
+    state = RUNNING
+    error = None
+
+    def collect_row():
+        rows.append({name: values[-1] for name, values in model.datacollector.model_vars.items()})
+
+    def send():
+        grid = downsample_categories(category_array(model), max_grid_size) if model is not None else None
+        connection.send((state, model.steps if model is not None else 0, rows, grid, error))
+        rows.clear()
+
+    last_send = time.perf_counter()
+    try:
+        model = MtbResistanceModel(**model_params)
+        collect_row()
+        send()
+        while not cancel.is_set():
+            if not resume.is_set():
+                state = PAUSED
+                send()
+                resume.wait()
+                state = RUNNING
+                continue
+
+            remaining = batch_size if days is None else min(batch_size, days - model.steps)
+            if remaining <= 0:
+                state = FINISHED
+                break
+            for _ in range(remaining):
+                model.step()
+                collect_row()
+
+            now = time.perf_counter()
+            if now - last_send >= min_interval:
+                send()
+                last_send = now
+        else:
+            state = CANCELLED
+    except Exception as exc:
+        state = FAILED
+        error = repr(exc)
+    send()
+    connection.close()
+
+
+class BackgroundRunner:
+    # Runs MtbResistanceModel(**model_params) in a separate process, so stepping never
+    # competes with the UI for the interpreter, until `days` steps have run (or forever
+    # if days is None). The worker steps batch_size steps between checks of the
+    # pause/resume/cancel controls and publishes at most max_fps snapshots a second:
+    #   {"version", "state", "step", "rows", "first_row", "row_count", "grid", "error"}
+    # where rows holds the reporter values of the days run since the previous snapshot,
+    # the first of them being row first_row of the run (row i is day i, row 0 the
+    # inoculum), row_count is the number of rows so
+    # far and grid is the category array of raster.py shrunk to at most max_grid_size
+    # cells a side. A consumer that skips snapshots catches up with rows_since(). Only the
+    # last max_rows rows are kept (all of them if max_rows is None).
+    def __init__(self, model_params, days=None, batch_size=1, max_fps=10, max_grid_size=250, max_rows=100_000):
+        self.model_params = dict(model_params)
+        self.days = days
+        self.batch_size = max(1, int(batch_size))
+        self.min_interval = 1.0 / max_fps if max_fps else 0.0
+        self.max_grid_size = max_grid_size
+        self.max_rows = max_rows
+
+        self.rows = []
+        self.first_row = 0
+        self.row_count = 0
+        self.state = PAUSED
+        self.snapshot = None
+        self._version = 0
+        self._condition = threading.Condition()
+
+        context = multiprocessing.get_context("spawn")
+        self._resume = context.Event()
+        self._cancel = context.Event()
+        self._connection, worker_connection = context.Pipe(duplex=False)
+        self._process = context.Process(
+            target=_run_model,
+            args=(self.model_params, days, self.batch_size, self.min_interval, max_grid_size,
+                  worker_connection, self._resume, self._cancel),
+            daemon=True,
+        )
+        self._reader = threading.Thread(target=self._receive, name="mtb-snapshots", daemon=True)
+
+    def start(self):
+        self._resume.set()
+        self._process.start()
+        self._reader.start()
+
+    def pause(self):
+        self._resume.clear()
+
+    def resume(self):
+        self._resume.set()
+
+    def cancel(self):
+        self._cancel.set()
+        self._resume.set()
+
+    def join(self, timeout=None):
+        self._reader.join(timeout)
+
+    def is_done(self):
+        return self.state in (FINISHED, CANCELLED, FAILED)
+
+    def wait_for_snapshot(self, seen_version, timeout=None):
+        # Blocks until a snapshot newer than seen_version is published; None on timeout.
+        with self._condition:
+            self._condition.wait_for(lambda: self._version > seen_version, timeout)
+            return self.snapshot if self._version > seen_version else None
+
+    def rows_since(self, start):
+        # (first, rows): the kept reporter rows from row `start` of the run on; first is
+        # later than start when older rows were already dropped.
+        with self._condition:
+            first = max(start, self.first_row)
+            return first, self.rows[first - self.first_row:]
+
+    def _receive(self):
+        while not self.is_done():
+            try:
+                state, step, rows, grid, error = self._connection.recv()
+            except EOFError:
+                # The worker died without reporting why.
+                self._process.join()
+                last = self.snapshot or {"step": 0, "grid": None}
+                state, step, rows, grid = FAILED, last["step"], [], last["grid"]
+                error = f"worker process exited with code {self._process.exitcode}"
+            self._publish(state, step, rows, grid, error)
+        self._process.join()
+
+    def _publish(self, state, step, rows, grid, error):
+        self.state = state
+        with self._condition:
+            first_row = self.row_count
+            self.rows.extend(rows)
+            self.row_count += len(rows)
+            # Trimmed in halves, so dropping old rows costs O(1) per row.
+            if self.max_rows is not None and len(self.rows) > 2 * self.max_rows:
+                dropped = len(self.rows) - self.max_rows
+                del self.rows[:dropped]
+                self.first_row += dropped
+
+            self._version += 1
+            self.snapshot = {
+                "version": self._version,
+                "state": state,
+                "step": step,
+                "rows": rows,
+                "first_row": first_row,
+                "row_count": self.row_count,
+                "grid": grid,
+                "error": error,
+            }
+            self._condition.notify_all()
@@ -0,0 +1,306 @@
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import statistics
+import argparse
+import subprocess
+import platform
+import resource
+import json
+import time
+import sys
+import os
+
+# Fresh-interpreter commands timed by run_startup_benchmarks: what every CLI invocation or
+# sweep worker pays before it simulates anything.
+STARTUP_CASES = {
+    "startup-cli-help": ["app.py", "--help"],
+    "startup-import-model": ["-c", "import model"],
+    "startup-short-run-headless": [
+        "-c", "from model import MtbResistanceModel\n"
+              "model = MtbResistanceModel(width=50, height=50, seed=0)\n"
+              "model.step()"],
+    "startup-short-run-simulator": [
+        "-c", "from mesa.experimental.devs import ABMSimulator\n"
+              "from model import MtbResistanceModel\n"
+              "model = MtbResistanceModel(width=50, height=50, seed=0, simulator=ABMSimulator())\n"
+              "model.step()"],
+}
+
+# Metrics where a larger value is better; every other metric is a time or memory cost.
+HIGHER_IS_BETTER = ("speedup", "steps_per_s", "agent_updates_per_s", "growth_steps_per_s", "treated_steps_per_s")
+# Time metrics only count as regressions once they are this many seconds slower: collect_s
+# and count_patterns_s take microseconds and swing by far more than --threshold between runs.
+NOISE_FLOOR_S = 1e-3
+
+
+def case_name(case):
+    regimen = case["drug_type"].replace(" ", "+")
+    name = (f"{case['engine']}-{case['width']}x{case['height']}-n{case['initial_mtb']}"
+            f"-{regimen}-start{case['day_start']}-d{case['days']}")
+    if "workers" in case:
+        name += f"-t{case['tiles']}-w{case['workers']}"
+    return name
+
+
+def build_cases(sizes, initials, regimens, engines, days, day_start):
+    cases = []
+    for engine in engines:
+        for size in sizes:
+            for initial_mtb in initials:
+                for drug_type in regimens:
+                    cases.append({
+                        "engine": engine,
+                        "width": size,
+                        "height": size,
+                        "initial_mtb": min(initial_mtb, size * size),
+                        "drug_type": drug_type,
+                        "day_start": day_start if day_start is not None else days // 2,
+                        "days": days,
+                    })
+    return cases
+
+
+def run_case(case, seed=0, repeats=5):
+    # Runs in a fresh process so that peak RSS belongs to this case alone.
+    from model import MtbResistanceModel
+    from app import count_model_patterns
+
+    t0 = time.perf_counter()
+    model = MtbResistanceModel(
+        seed=seed,
+        drug_type=case["drug_type"],
+        day_start=case["day_start"],
+        width=case["width"],
+        height=case["height"],
+        initial_mtb=case["initial_mtb"],
+        engine=case["engine"],
+        tiles=case.get("tiles", 4),
+        workers=case.get("workers", 0),
+    )
+    construct_s = time.perf_counter() - t0
+
+    step_times = {"growth": [], "treated": []}
+    agent_updates = 0
+    for _ in range(case["days"]):
+        agent_updates += model.counts.total()
+        t0 = time.perf_counter()
+        model.step()
+        elapsed = time.perf_counter() - t0
+        step_times["treated" if model.steps >= model.day_start_treatment else "growth"].append(elapsed)
+    all_steps = step_times["growth"] + step_times["treated"]
+    run_s = sum(all_steps)
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        model.datacollector.collect(model)
+    collect_s = (time.perf_counter() - t0) / repeats
+
+    t0 = time.perf_counter()
+    for _ in range(repeats):
+        count_model_patterns(model)
+    count_patterns_s = (time.perf_counter() - t0) / repeats
+
+    def rate(times):
+        return len(times) / sum(times) if times and sum(times) > 0 else None
+
+    def median(times):
+        return statistics.median(times) if times else None
+
+    return {
+        "construct_s": construct_s,
+        "growth_step_s": median(step_times["growth"]),
+        "treated_step_s": median(step_times["treated"]),
+        "run_s": run_s,
+        "steps_per_s": rate(all_steps),
+        "agent_updates_per_s": agent_updates / run_s if run_s > 0 else None,
+        "growth_steps_per_s": rate(step_times["growth"]),
+        "treated_steps_per_s": rate(step_times["treated"]),
+        "collect_s": collect_s,
+        "count_patterns_s": count_patterns_s,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0,
+        "final_population": model.counts.total(),
+    }
+
+
+def build_scaling_cases(sizes, initials, regimens, days, day_start, workers, tiles):
+    # The tiled engine on every grid with each worker count; the tiling is fixed, so all
+    # worker counts of a grid simulate exactly the same trajectory.
+    cases = []
+    for case in build_cases(sizes, initials, regimens, ["tiled"], days, day_start):
+        for n in workers:
+            cases.append(dict(case, tiles=tiles, workers=n))
+    return cases
+
+
+def add_speedups(results):
+    # speedup = run_s with the fewest workers / run_s, per grid; with workers=0 as the
+    # reference that is the speedup over stepping every tile in the model's own process.
+    reference = {}
+    for entry in results.values():
+        case = entry["case"]
+        group = case_name(dict(case, workers=None))
+        if group not in reference or case["workers"] < reference[group]["case"]["workers"]:
+            reference[group] = entry
+    for entry in results.values():
+        base = reference[case_name(dict(entry["case"], workers=None))]["metrics"]["run_s"]
+        run_s = entry["metrics"]["run_s"]
+        entry["metrics"]["speedup"] = base / run_s if run_s else None
+        print(f"{case_name(entry['case'])}: speedup {entry['metrics']['speedup']:.2f}x "
+              f"on {entry['case']['workers']} worker(s), {os.cpu_count()} core(s) available")
+
+
+def run_startup_benchmarks(repeats=5):
+    # Best wall time of each STARTUP_CASES command over `repeats` fresh interpreters, or
+    # None if the command fails.
+    here = os.path.dirname(os.path.abspath(__file__))
+    results = {}
+    for name, arguments in STARTUP_CASES.items():
+        print(f"Running {name} ...", flush=True)
+        times = []
+        for _ in range(repeats):
+            t0 = time.perf_counter()
+            completed = subprocess.run([sys.executable, *arguments], cwd=here, capture_output=True)
+            elapsed = time.perf_counter() - t0
+            if completed.returncode != 0:
+                times = []
+                break
+            times.append(elapsed)
+        wall_s = min(times) if times else None
+        results[name] = {"case": {"command": arguments}, "metrics": {"wall_s": wall_s}}
+        print(f"  wall_s={wall_s:.4g}" if wall_s is not None else "  failed")
+    return results
+
+
+def best_of(runs):
+    # Best value of each metric over repeated runs, which is far less noisy than the mean.
+    best = dict(runs[0])
+    for metric in best:
+        values = [run[metric] for run in runs if run[metric] is not None]
+        if metric == "final_population" or not values:
+            continue
+        best[metric] = max(values) if metric in HIGHER_IS_BETTER else min(values)
+    return best
+
+
+def run_benchmarks(cases, seed=0, repeats=3):
+    results = {}
+    context = multiprocessing.get_context("spawn")
+    for case in cases:
+        name = case_name(case)
+        print(f"Running {name} ...", flush=True)
+        runs = []
+        for _ in range(repeats):
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                runs.append(pool.submit(run_case, case, seed).result())
+        metrics = best_of(runs)
+        results[name] = {"case": case, "metrics": metrics}
+        print("  " + ", ".join(f"{key}={value:.4g}" for key, value in metrics.items() if value is not None))
+    return results
+
+
+def compare(results, baseline, threshold):
+    # Returns a list of (case, metric, baseline value, current value, relative change) for
+    # every metric that got worse by more than threshold (and, for times, by more than
+    # NOISE_FLOOR_S).
+    regressions = []
+    for name, current in results.items():
+        if name not in baseline["results"]:
+            continue
+        old_metrics = baseline["results"][name]["metrics"]
+        for metric, value in current["metrics"].items():
+            old = old_metrics.get(metric)
+            if metric == "final_population" or value is None or not old:
+                continue
+            if metric in HIGHER_IS_BETTER:
+                change = old / value - 1.0 if value else float("inf")
+            else:
+                change = value / old - 1.0
+                if metric.endswith("_s") and value - old <= NOISE_FLOOR_S:
+                    continue
+            if change > threshold:
+                regressions.append((name, metric, old, value, change))
+    return regressions
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Mtb simulation benchmarks')
+
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 250],
+                        help='Grid side lengths (default: 50 100 250; up to 1000 for large-grid runs)')
+
+    parser.add_argument('--initial', type=int, nargs='+', default=[200],
+                        help='Initial populations (default: 200)')
+
+    parser.add_argument('--drug-type', type=str, nargs='+', default=["RIF INH PZA EMB"],
+                        help='Regimens (default: "RIF INH PZA EMB")')
+
+    parser.add_argument('--engines', type=str, nargs='+', default=["agent", "numpy"],
+                        choices=["agent", "numpy", "tiled"], help='Engines (default: agent numpy)')
+
+    parser.add_argument('--scaling', type=int, nargs='+', default=None, metavar='WORKERS',
+                        help='Run the tiled engine with each of these worker counts instead of --engines '
+                             'and report speedup against the first, e.g. --scaling 0 1 2 4')
+
+    parser.add_argument('--tiles', type=int, default=4,
+                        help='Tiles per grid side for --scaling (default: 4)')
+
+    parser.add_argument('--days', type=int, default=40,
+                        help='Days per run (default: 40)')
+
+    parser.add_argument('--start', type=int, default=None,
+                        help='Treatment start day; steps before it count as growth (default: days / 2)')
+
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed (default: 0)')
+
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='Runs per case; the best value of each metric is kept (default: 3)')
+
+    parser.add_argument('--startup', action='store_true',
+                        help='Time interpreter startup, imports and a short headless run instead of the simulation cases')
+
+    parser.add_argument('--output', type=str, default="benchmark_results.json",
+                        help='Where to write results (default: benchmark_results.json)')
+
+    parser.add_argument('--baseline', type=str, default=None,
+                        help='Results file to compare against; exits with status 1 on regressions')
+
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative slowdown that counts as a regression (default: 0.10)')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    if args.startup:
+        results = run_startup_benchmarks(repeats=max(args.repeats, 5))
+    elif args.scaling:
+        cases = build_scaling_cases(args.sizes, args.initial, args.drug_type, args.days, args.start,
+                                    args.scaling, args.tiles)
+        results = run_benchmarks(cases, seed=args.seed, repeats=args.repeats)
+        add_speedups(results)
+    else:
+        cases = build_cases(args.sizes, args.initial, args.drug_type, args.engines, args.days, args.start)
+        results = run_benchmarks(cases, seed=args.seed, repeats=args.repeats)
+
+    with open(args.output, "w") as f:
+        json.dump({
+            "python": sys.version.split()[0],
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "repeats": args.repeats,
+            "results": results,
+        }, f, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} regression(s) over {args.threshold:.0%} against {args.baseline}:")
+            for name, metric, old, value, change in regressions:
+                print(f"  {name} {metric}: {old:.4g} -> {value:.4g} ({change:+.1%} worse)")
+            sys.exit(1)
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}.")
@@ -0,0 +1,70 @@
+from pharmacodynamics import DRUG_BITS, N_MASKS
+
+N_PATTERNS = N_MASKS * 2
+
+
+def pattern_key(resistance_mask, is_persister):
+    return resistance_mask << 1 | is_persister
+
+
+class PopulationCounts:
+    # Live histogram of bacteria by (resistance mask, persister flag), updated by the
+    # engines on birth, death and phenotype switching. Mutations only happen at birth,
+    # so the child's mask is counted when it is placed.
+    __slots__ = ("histogram",)
+
+    def __init__(self, histogram=None):
+        self.histogram = list(histogram) if histogram is not None else [0] * N_PATTERNS
+
+    @classmethod
+    def from_agents(cls, agents):
+        counts = cls()
+        for agent in agents:
+            counts.add(agent.resistance_mask, agent.is_persister)
+        return counts
+
+    def __eq__(self, other):
+        return isinstance(other, PopulationCounts) and self.histogram == other.histogram
+
+    def __repr__(self):
+        return f"PopulationCounts({dict(self.items())})"
+
+    def add(self, resistance_mask, is_persister):
+        self.histogram[resistance_mask << 1 | is_persister] += 1
+
+    def remove(self, resistance_mask, is_persister):
+        self.histogram[resistance_mask << 1 | is_persister] -= 1
+
+    def switch(self, resistance_mask, to_persister):
+        key = resistance_mask << 1
+        if to_persister:
+            self.histogram[key] -= 1
+            self.histogram[key | 1] += 1
+        else:
+            self.histogram[key | 1] -= 1
+            self.histogram[key] += 1
+
+    def apply(self, delta):
+        histogram = self.histogram
+        for key, change in enumerate(delta):
+            if change:
+                histogram[key] += int(change)
+
+    def items(self):
+        # ((resistance_mask, is_persister), count) for every non-empty class.
+        for key, count in enumerate(self.histogram):
+            if count:
+                yield (key >> 1, bool(key & 1)), count
+
+    def total(self):
+        return sum(self.histogram)
+
+    def susceptible(self):
+        return self.histogram[pattern_key(0, False)]
+
+    def persisters(self):
+        return sum(self.histogram[1::2])
+
+    def resistant(self, drug_name_upper):
+        bit = DRUG_BITS[drug_name_upper]
+        return sum(count for key, count in enumerate(self.histogram) if (key >> 1) & bit)
@@ -0,0 +1,250 @@
+from counters import N_PATTERNS
+from numpy_engine import _untimed
+from pharmacodynamics import DRUGS, N_MASKS
+import numpy as np
+
+DEFAULT_BLOCK_SIZE = 2
+# Frontier estimate: the fraction of a block's bacteria with an empty Moore neighbour is
+# min(1, FRONTIER_SCALE * (1 - occupancy) ** FRONTIER_POWER), occupancy being that of the
+# slot-weighted 3x3 block neighbourhood. Bacteria grow in compact colonies, so this is far
+# below the 1 - occupancy ** 8 of bacteria scattered at random. The constants are fitted on
+# 2x2 blocks to the daily totals of full runs with uniform, focus and foci seeding on
+# partly empty 150x150 to 600x600 grids (see tests/test_fast_forward.py); they do not
+# carry over to other block sizes.
+FRONTIER_SCALE = 1.8
+FRONTIER_POWER = 0.94
+
+# Block offsets of the 3x3 block neighbourhood; index 4 is the block itself.
+BLOCK_DX = np.array([-1, -1, -1, 0, 0, 0, 1, 1, 1])
+BLOCK_DY = np.array([-1, 0, 1, -1, 0, 1, -1, 0, 1])
+
+
+def neighbour_slot_weights(block_size):
+    # Expected number of a bacterium's 8 Moore neighbours that lie in each block of its
+    # 3x3 block neighbourhood, for a bacterium anywhere in a block_size x block_size block.
+    b = float(block_size)
+    side = (3 * b - 2) / (b * b)
+    corner = 1 / (b * b)
+    own = 8 - 4 * side - 4 * corner
+    return np.array([corner, side, corner, side, own, side, corner, side, corner])
+
+
+class CompartmentPopulation:
+    # Aggregate stand-in for the population during the untreated phase of
+    # MtbResistanceModel(fast_forward=True). The grid is cut into block_size x block_size
+    # blocks and each block only holds counts per PopulationCounts class; a day is one
+    # tau-leap (tau = the model's one-day step) of the same processes the engines run
+    # without drugs:
+    #   reversion    persisters of a block turn replicating with Binomial(n, p)
+    #   replication  replicating bacteria of a block divide with Binomial(n, r * f), where
+    #                f estimates the fraction of them with an empty neighbour (see
+    #                FRONTIER_SCALE)
+    #   mutation     per drug, Binomial(children, rate) of the eligible children mutate
+    #   placement    children go to the blocks around their parent's, Multinomial in
+    #                proportion to the empty neighbour slots there that the parent block's
+    #                bacteria reach; a block receiving more children than it has empty
+    #                cells keeps a uniform subset of them
+    # materialize() turns the counts back into bacteria on cells.
+    def __init__(self, width, height, block_size=DEFAULT_BLOCK_SIZE):
+        self.width = int(width)
+        self.height = int(height)
+        self.block_size = int(block_size)
+        self.nbx = -(-self.width // self.block_size)
+        self.nby = -(-self.height // self.block_size)
+
+        block_x = np.minimum(self.width - np.arange(self.nbx) * self.block_size, self.block_size)
+        block_y = np.minimum(self.height - np.arange(self.nby) * self.block_size, self.block_size)
+        self.capacity = np.outer(block_x, block_y)
+        self.slot_weights = neighbour_slot_weights(self.block_size)
+        self.restore(np.zeros((self.nbx, self.nby, N_PATTERNS), dtype=np.int32))
+
+    def restore(self, counts):
+        # Sets the per-block counts, e.g. from a snapshot, and the totals kept alongside
+        # them: bacteria and persisters per block and the population histogram.
+        self.counts = np.array(counts, dtype=np.int32)
+        self.occupied = self.counts.sum(axis=-1, dtype=np.int64)
+        self.persisters = self.counts[..., 1::2].sum(axis=-1, dtype=np.int64)
+        self._histogram = self.counts.sum(axis=(0, 1), dtype=np.int64)
+
+    def _blocks(self, x, y):
+        return np.asarray(x) // self.block_size, np.asarray(y) // self.block_size
+
+    def add(self, x, y, is_persister, resistance):
+        keys = np.asarray(resistance, dtype=np.int64) << 1 | np.asarray(is_persister, dtype=bool)
+        bx, by = self._blocks(x, y)
+        counts = self.counts.copy()
+        np.add.at(counts, (bx, by, keys), 1)
+        self.restore(counts)
+
+    def histogram(self):
+        return self._histogram.copy()
+
+    def __len__(self):
+        return int(self._histogram.sum())
+
+    def _neighbourhood(self, per_block, outside, bx, by):
+        # (n, 9) values of per_block over the 3x3 block neighbourhoods of blocks (bx, by),
+        # `outside` beyond the grid.
+        padded = np.pad(per_block, 1, constant_values=outside)
+        return padded[bx[:, None] + 1 + BLOCK_DX, by[:, None] + 1 + BLOCK_DY]
+
+    def step(self, model):
+        # One untreated day. Returns the event counts of the day. Draws are only made for
+        # the non-zero (block, class) entries of the blocks that can change, so the cost
+        # follows the growing edge of the population rather than the grid or its size.
+        rng = model.random_stream.generator
+        profiler = model.profiler
+        phase = profiler.phase if profiler is not None else _untimed
+        counts = self.counts
+        events = {"switches": 0, "births": 0, "mutations": 0}
+
+        with phase("switching"):
+            pbx, pby = np.nonzero(self.persisters)
+            row, mask = np.nonzero(counts[pbx, pby, 1::2])
+            bx, by = pbx[row], pby[row]
+            reverted = rng.binomial(counts[bx, by, 2 * mask + 1], model.prob_persister_to_susceptible_no_drug)
+            counts[bx, by, 2 * mask + 1] -= reverted
+            counts[bx, by, 2 * mask] += reverted
+            np.subtract.at(self.persisters, (bx, by), reverted)
+            per_mask = np.bincount(mask, weights=reverted, minlength=N_MASKS).astype(np.int64)
+            self._histogram[1::2] -= per_mask
+            self._histogram[0::2] += per_mask
+            events["switches"] = int(reverted.sum())
+
+        with phase("replication"):
+            occupancy = np.divide(self.occupied, self.capacity, out=np.ones(self.occupied.shape),
+                                  where=self.capacity > 0)
+            # Only blocks next to an empty cell can grow.
+            room = np.pad(self.occupied < self.capacity, 1)
+            near_room = np.zeros(occupancy.shape, dtype=bool)
+            for dx, dy in zip(BLOCK_DX.tolist(), BLOCK_DY.tolist()):
+                near_room |= room[1 + dx:self.nbx + 1 + dx, 1 + dy:self.nby + 1 + dy]
+            abx, aby = np.nonzero((self.occupied > self.persisters) & near_room)
+            neighbourhood = self._neighbourhood(occupancy, 1.0, abx, aby) @ self.slot_weights / 8.0
+            frontier = np.zeros(occupancy.shape)
+            frontier[abx, aby] = np.minimum(
+                1.0, FRONTIER_SCALE * (1.0 - np.minimum(neighbourhood, 1.0)) ** FRONTIER_POWER)
+            row, mask = np.nonzero(counts[abx, aby, 0::2])
+            bx, by = abx[row], aby[row]
+            born = rng.binomial(counts[bx, by, 2 * mask], model.replication_prob_per_day * frontier[bx, by])
+
+            # Children that mutate leave `born`, so a child mutates at most once.
+            mutated = []
+            for i, drug in enumerate(DRUGS):
+                bit = 1 << i
+                eligible = (mask & bit) == 0
+                mutants = np.zeros_like(born)
+                mutants[eligible] = rng.binomial(born[eligible], getattr(model, f"{drug.lower()}_mutation_rate"))
+                born -= mutants
+                hit = mutants > 0
+                mutated.append((bx[hit], by[hit], mask[hit] | bit, mutants[hit]))
+                events["mutations"] += int(mutants.sum())
+            bx, by, mask, born = (np.concatenate([column] + [entry[j] for entry in mutated])
+                                  for j, column in enumerate((bx, by, mask, born)))
+            has_born = born > 0
+            bx, by, mask, born = bx[has_born], by[has_born], mask[has_born], born[has_born]
+            if born.size == 0:
+                return self._report(profiler, events)
+
+            empty = self.capacity - self.occupied
+            # A partly filled block's bacteria sit against its fuller neighbours, so its
+            # children reach an adjacent block in proportion to how far it has filled along
+            # each axis crossed.
+            reach = occupancy[bx, by, None] ** ((BLOCK_DX != 0).astype(int) + (BLOCK_DY != 0))
+            slots = self._neighbourhood(empty / np.maximum(self.capacity, 1), 0.0, bx, by) * self.slot_weights * reach
+            total = slots.sum(axis=-1, keepdims=True)
+            destination = np.divide(slots, total, out=np.zeros(slots.shape), where=total > 0)
+            destination[:, 4] += (total[:, 0] == 0)
+
+            # Children per (destination block, mask); off-grid blocks have no slots.
+            moved = rng.multinomial(born, destination)
+            row, d = np.nonzero(moved)
+            block = (bx[row] + BLOCK_DX[d]) * self.nby + by[row] + BLOCK_DY[d]
+            entry, inverse = np.unique(block * N_MASKS + mask[row], return_inverse=True)
+            arrivals = np.bincount(inverse, weights=moved[row, d]).astype(np.int64)
+            block, mask = np.divmod(entry, N_MASKS)
+
+            # Entries are sorted by block, so each block's entries are contiguous. A block
+            # receiving more children than it has empty cells keeps a uniform subset of
+            # them: a multivariate hypergeometric draw, taken one entry at a time.
+            blocks, first, length = np.unique(block, return_index=True, return_counts=True)
+            arrived = np.add.reduceat(arrivals, first)
+            room = empty.ravel()[blocks]
+            over = np.flatnonzero(arrived > room)
+            first, length, left, room = first[over], length[over], arrived[over], room[over]
+            for j in range(int(length.max(initial=0))):
+                has = length > j
+                entry = first[has] + j
+                kept = rng.hypergeometric(arrivals[entry], left[has] - arrivals[entry], room[has])
+                left[has] -= arrivals[entry]
+                room[has] -= kept
+                arrivals[entry] = kept
+
+            counts.reshape(-1, N_PATTERNS)[block, 2 * mask] += arrivals
+            np.add.at(self.occupied.reshape(-1), block, arrivals)
+            self._histogram[0::2] += np.bincount(mask, weights=arrivals, minlength=N_MASKS).astype(np.int64)
+            events["births"] = int(arrivals.sum())
+
+        return self._report(profiler, events)
+
+    def _report(self, profiler, events):
+        if profiler is not None:
+            for name, count in events.items():
+                profiler.current.events[name] += count
+        return events
+
+    def _cell_scores(self):
+        # Per-cell occupancy interpolated between block centres, so a block's bacteria
+        # fill the side facing its fuller neighbours and colonies stay compact.
+        occupied = self.occupied
+        density = np.divide(occupied, self.capacity, out=np.zeros(occupied.shape), where=self.capacity > 0)
+        centre_x = (np.arange(self.nbx) + 0.5) * self.block_size - 0.5
+        centre_y = (np.arange(self.nby) + 0.5) * self.block_size - 0.5
+        along_y = np.stack([np.interp(np.arange(self.height), centre_y, row) for row in density])
+        return np.stack([np.interp(np.arange(self.width), centre_x, column) for column in along_y.T], axis=1)
+
+    def materialize(self, rng=None):
+        # (x, y, is_persister, resistance) of concrete bacteria matching the counts: in each
+        # block the cells with the highest interpolated occupancy (with random tie-breaks
+        # when rng is given) are occupied, and classes are spread over them at random.
+        scores = self._cell_scores()
+        if rng is not None:
+            scores = scores + 1e-3 * rng.random(scores.shape)
+        cell_x, cell_y = np.meshgrid(np.arange(self.width), np.arange(self.height), indexing="ij")
+        block = (cell_x // self.block_size) * self.nby + cell_y // self.block_size
+        order = np.lexsort((-scores.ravel(), block.ravel()))
+        first_cell = np.concatenate([[0], np.cumsum(self.capacity.ravel())])[:-1]
+        occupied = self.occupied.ravel()
+
+        rank_in_block = np.arange(order.size) - np.repeat(first_cell, self.capacity.ravel())
+        chosen = order[rank_in_block < np.repeat(occupied, self.capacity.ravel())]
+        # Classes in block order, matching the chosen cells block by block.
+        keys = np.repeat(np.tile(np.arange(N_PATTERNS), self.nbx * self.nby), self.counts.ravel())
+        if rng is not None:
+            blocks_of_keys = np.repeat(np.arange(self.nbx * self.nby), occupied)
+            keys = keys[np.lexsort((rng.random(keys.size), blocks_of_keys))]
+        x, y = np.divmod(chosen, self.height)
+        return (x.astype(np.int32), y.astype(np.int32), (keys & 1).astype(bool), (keys >> 1).astype(np.uint8))
+
+
+def compare_with_agent_runs(seeds, days, fast_forward_engine="agent", **params):
+    # Mean DataCollector series of fast-forwarded runs and of full agent-based runs over
+    # `seeds`, as {reporter: (fast_forward_mean, agent_mean, fast_forward_sd, agent_sd)}
+    # of per-day arrays.
+    from model import MtbResistanceModel
+
+    series = {True: [], False: []}
+    for fast_forward in (True, False):
+        for seed in seeds:
+            model = MtbResistanceModel(seed=seed, fast_forward=fast_forward,
+                                       engine=fast_forward_engine if fast_forward else "agent", **params)
+            for _ in range(days):
+                model.step()
+            series[fast_forward].append(model.datacollector.model_vars)
+    comparison = {}
+    for reporter in series[False][0]:
+        fast = np.array([run[reporter] for run in series[True]], dtype=float)
+        full = np.array([run[reporter] for run in series[False]], dtype=float)
+        comparison[reporter] = (fast.mean(axis=0), full.mean(axis=0), fast.std(axis=0), full.std(axis=0))
+    return comparison
+
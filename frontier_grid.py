@@ -0,0 +1,51 @@
+from mesa.space import SingleGrid
+import numpy as np
+
+MOORE_OFFSETS = ((-1, -1), (-1, 0), (-1, 1), (0, -1), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+class FrontierGrid(SingleGrid):
+    # SingleGrid that also tracks, for every cell, how many of its Moore neighbours
+    # are empty, and the frontier: occupied cells with at least one empty neighbour.
+    # Both are updated incrementally in place_agent/remove_agent, so a bacterium can
+    # tell in O(1) whether a replication attempt has anywhere to go.
+    def __init__(self, width, height, torus=False):
+        if torus:
+            raise ValueError("FrontierGrid only supports bounded grids (torus=False).")
+        super().__init__(width, height, torus=False)
+
+        inside = np.zeros((width + 2, height + 2), dtype=np.int64)
+        inside[1:-1, 1:-1] = 1
+        counts = sum(inside[1 + dx:width + 1 + dx, 1 + dy:height + 1 + dy] for dx, dy in MOORE_OFFSETS)
+        self.empty_neighbor_counts = counts.tolist()
+        self.frontier = set()
+
+    def _neighbor_cells(self, x, y):
+        width, height = self.width, self.height
+        for dx, dy in MOORE_OFFSETS:
+            nx, ny = x + dx, y + dy
+            if 0 <= nx < width and 0 <= ny < height:
+                yield nx, ny
+
+    def place_agent(self, agent, pos):
+        super().place_agent(agent, pos)
+        x, y = pos
+        counts = self.empty_neighbor_counts
+        if counts[x][y]:
+            self.frontier.add(pos)
+        for nx, ny in self._neighbor_cells(x, y):
+            counts[nx][ny] -= 1
+            if counts[nx][ny] == 0:
+                self.frontier.discard((nx, ny))
+
+    def remove_agent(self, agent):
+        pos = agent.pos
+        super().remove_agent(agent)
+        x, y = pos
+        counts = self.empty_neighbor_counts
+        grid = self._grid
+        self.frontier.discard(pos)
+        for nx, ny in self._neighbor_cells(x, y):
+            if counts[nx][ny] == 0 and grid[nx][ny] is not None:
+                self.frontier.add((nx, ny))
+            counts[nx][ny] += 1
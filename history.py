@@ -0,0 +1,145 @@
+import numpy as np
+import struct
+import json
+import zlib
+
+# File layout:
+#   MAGIC
+#   chunk 0, chunk 1, ...       zlib-compressed frames, chunk_days per chunk
+#   index                       JSON: width, height, chunk_days, steps, chunk offsets/lengths, metadata
+#   footer                      index offset and length (two little-endian uint64) and MAGIC
+#
+# A frame is a (width, height) uint8 array indexed [x, y], like the grid: 0 for an empty
+# cell, otherwise 1 + (resistance_mask << 1 | is_persister). Within a chunk, every frame
+# but the first is stored XORed with the previous one, so cells that did not change since
+# the day before compress to runs of zeros.
+MAGIC = b"MTBHIST1"
+FOOTER = struct.Struct("<QQ8s")
+
+
+def encode_frame(model):
+    x, y, is_persister, resistance = model.get_population_arrays()
+    frame = np.zeros((model.width, model.height), dtype=np.uint8)
+    frame[x, y] = ((resistance << 1) | is_persister) + 1
+    return frame
+
+
+def occupancy(frame):
+    return frame > 0
+
+
+def persister_flags(frame):
+    return (frame > 0) & ((frame - 1) & 1).astype(bool)
+
+
+def resistance_masks(frame):
+    # Resistance bitmask of every cell (0 for empty cells as well as susceptible bacteria).
+    return np.where(frame > 0, (frame - 1) >> 1, 0).astype(np.uint8)
+
+
+class HistoryRecorder:
+    # Appends one frame per record() call and writes a compressed chunk every chunk_days
+    # frames, so at most one chunk of frames is ever held in memory. The index is written
+    # by close(); a file that was never closed cannot be read.
+    def __init__(self, path, width, height, chunk_days=16, level=6, metadata=None):
+        self.width = int(width)
+        self.height = int(height)
+        self.chunk_days = int(chunk_days)
+        self.level = level
+        self.metadata = metadata or {}
+        self.steps = []
+        self.chunks = []
+        self._pending = []
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def record(self, model):
+        self.append(encode_frame(model), model.steps)
+
+    def append(self, frame, step):
+        if frame.shape != (self.width, self.height):
+            raise ValueError(f"Frame shape {frame.shape} does not match the history grid ({self.width}, {self.height}).")
+        self._pending.append(frame.astype(np.uint8, copy=False))
+        self.steps.append(int(step))
+        if len(self._pending) == self.chunk_days:
+            self._write_chunk()
+
+    def _write_chunk(self):
+        frames = np.stack(self._pending)
+        deltas = frames.copy()
+        deltas[1:] ^= frames[:-1]
+        data = zlib.compress(deltas.tobytes(), self.level)
+        self.chunks.append((self._file.tell(), len(data)))
+        self._file.write(data)
+        self._pending = []
+
+    def close(self):
+        if self._file.closed:
+            return
+        if self._pending:
+            self._write_chunk()
+        index = json.dumps({
+            "width": self.width,
+            "height": self.height,
+            "chunk_days": self.chunk_days,
+            "steps": self.steps,
+            "chunks": self.chunks,
+            "metadata": self.metadata,
+        }).encode()
+        index_offset = self._file.tell()
+        self._file.write(index)
+        self._file.write(FOOTER.pack(index_offset, len(index), MAGIC))
+        self._file.close()
+
+
+class HistoryReader:
+    # Memory-maps a history file; reading a frame decompresses only the chunk it is in, and
+    # the most recently used chunk is kept so scrubbing through neighbouring days is cheap.
+    def __init__(self, path):
+        self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        if bytes(self._data[:len(MAGIC)]) != MAGIC:
+            raise ValueError(f"{path} is not an Mtb history file.")
+        index_offset, index_length, magic = FOOTER.unpack(bytes(self._data[-FOOTER.size:]))
+        if magic != MAGIC:
+            raise ValueError(f"{path} has no index; the recording was not closed.")
+        index = json.loads(bytes(self._data[index_offset:index_offset + index_length]))
+
+        self.width = index["width"]
+        self.height = index["height"]
+        self.chunk_days = index["chunk_days"]
+        self.steps = index["steps"]
+        self.chunks = index["chunks"]
+        self.metadata = index["metadata"]
+        self._cached_chunk = None
+        self._cached_frames = None
+
+    def __len__(self):
+        return len(self.steps)
+
+    def __getitem__(self, i):
+        # Frame i, in recording order; see also frame_at_step.
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(f"Frame {i} out of range for a history of {len(self)} frames.")
+        chunk, offset = divmod(i, self.chunk_days)
+        return self._chunk_frames(chunk)[offset]
+
+    def frame_at_step(self, step):
+        return self[self.steps.index(step)]
+
+    def _chunk_frames(self, chunk):
+        if chunk != self._cached_chunk:
+            start, length = self.chunks[chunk]
+            deltas = np.frombuffer(zlib.decompress(self._data[start:start + length]), dtype=np.uint8)
+            frames = np.bitwise_xor.accumulate(deltas.reshape(-1, self.width, self.height), axis=0)
+            frames.flags.writeable = False
+            self._cached_chunk = chunk
+            self._cached_frames = frames
+        return self._cached_frames
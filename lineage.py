@@ -0,0 +1,203 @@
+from pharmacodynamics import N_MASKS
+import numpy as np
+
+ROOT_CLONE = 0
+NO_PARENT = -1
+
+# One row per clone: its id, the clone it arose from, the day it arose, the resistance
+# bits its founding mutation added and its full resistance mask.
+CLONE_FIELDS = (
+    ("clone", np.int32),
+    ("parent", np.int32),
+    ("birth_day", np.int32),
+    ("mutation", np.uint8),
+    ("mask", np.uint8),
+)
+
+
+class LineageStore:
+    # Clone lineage of a run, for MtbResistanceModel(lineage=True). A clone is every
+    # bacterium descended from one mutation event without a further mutation, so a row is
+    # appended per mutation, not per division; the founding inoculum is ROOT_CLONE. Each
+    # bacterium carries only its clone id.
+    #
+    # census() records the size of every living clone once a day. prune() drops the rows
+    # and size history of clones that are extinct and have no living descendant clone;
+    # per-pattern origin counts and first-origin days are kept separately, so
+    # time_to_origin() and origin_counts() still cover pruned clones.
+    def __init__(self, capacity=1024):
+        self.columns = {name: np.empty(capacity, dtype=dtype) for name, dtype in CLONE_FIELDS}
+        self.n_clones = 0
+        self.next_id = 0
+        self.pattern_origins = np.zeros(N_MASKS, dtype=np.int64)
+        self.first_origin_day = np.full(N_MASKS, -1, dtype=np.int64)
+
+        self.census_days = []
+        self.census_offsets = [0]
+        self._census_clones = []
+        self._census_sizes = []
+        self.live = np.empty(0, dtype=np.int32)
+
+        self.record_many(np.array([NO_PARENT]), np.zeros(1, dtype=np.uint8), np.zeros(1, dtype=np.uint8), 0)
+
+    def __len__(self):
+        return self.n_clones
+
+    def _grow(self, n):
+        capacity = len(self.columns["clone"])
+        if self.n_clones + n > capacity:
+            capacity = max(2 * capacity, self.n_clones + n)
+            for name, column in self.columns.items():
+                grown = np.empty(capacity, dtype=column.dtype)
+                grown[:self.n_clones] = column[:self.n_clones]
+                self.columns[name] = grown
+
+    def record(self, parent, parent_mask, child_mask, day):
+        # New clone for one mutant child; returns its id.
+        return int(self.record_many(np.array([parent]), np.array([parent_mask]), np.array([child_mask]), day)[0])
+
+    def record_many(self, parents, parent_masks, child_masks, day):
+        # New clones for several mutant children born on the same day; returns their ids.
+        n = len(parents)
+        self._grow(n)
+        ids = np.arange(self.next_id, self.next_id + n, dtype=np.int32)
+        child_masks = np.asarray(child_masks, dtype=np.uint8)
+        rows = slice(self.n_clones, self.n_clones + n)
+        self.columns["clone"][rows] = ids
+        self.columns["parent"][rows] = parents
+        self.columns["birth_day"][rows] = day
+        self.columns["mutation"][rows] = child_masks & ~np.asarray(parent_masks, dtype=np.uint8)
+        self.columns["mask"][rows] = child_masks
+        self.n_clones += n
+        self.next_id += n
+
+        np.add.at(self.pattern_origins, child_masks, 1)
+        first = self.first_origin_day[child_masks] < 0
+        self.first_origin_day[child_masks[first]] = day
+        return ids
+
+    def census(self, day, clone_ids):
+        # Records the size of every clone with a living bacterium, given every living
+        # bacterium's clone id.
+        clones, sizes = np.unique(np.asarray(clone_ids, dtype=np.int32), return_counts=True)
+        self.live = clones
+        self.census_days.append(int(day))
+        self._census_clones.append(clones)
+        self._census_sizes.append(sizes.astype(np.int32))
+        self.census_offsets.append(self.census_offsets[-1] + clones.size)
+
+    def _rows(self, clones):
+        # Row of each clone id in the (id-sorted) columns, -1 for pruned ids.
+        ids = self.columns["clone"][:self.n_clones]
+        rows = np.minimum(np.searchsorted(ids, clones), max(self.n_clones - 1, 0))
+        return np.where(ids[rows] == clones, rows, -1)
+
+    def prune(self):
+        # Drops clones that are extinct and have no living descendant clone. Returns the
+        # number of clones dropped.
+        n = self.n_clones
+        parents = self._rows(self.columns["parent"][:n])
+        keep = np.zeros(n, dtype=bool)
+        keep[self._rows(self.live)] = True
+        keep[0] = True
+        # Parents always precede their children, so one backwards pass marks every
+        # ancestor of a kept clone.
+        for row in range(n - 1, 0, -1):
+            if keep[row] and parents[row] >= 0:
+                keep[parents[row]] = True
+        dropped = n - int(keep.sum())
+        if not dropped:
+            return 0
+
+        for name, column in self.columns.items():
+            column[:keep.sum()] = column[:n][keep]
+        self.n_clones = int(keep.sum())
+
+        if self._census_clones:
+            clones = np.concatenate(self._census_clones)
+            sizes = np.concatenate(self._census_sizes)
+            retained = self._rows(clones) >= 0
+            kept_before = np.concatenate([[0], np.cumsum(retained)])
+            self._census_clones = [clones[retained]]
+            self._census_sizes = [sizes[retained]]
+            self.census_offsets = kept_before[self.census_offsets].tolist()
+        return dropped
+
+    def clones(self):
+        # {field: array} of every retained clone, in id order.
+        return {name: column[:self.n_clones].copy() for name, column in self.columns.items()}
+
+    def ancestry(self, clone):
+        # Clone ids from `clone` back to ROOT_CLONE.
+        path = [int(clone)]
+        while path[-1] != ROOT_CLONE:
+            row = int(self._rows(np.array([path[-1]]))[0])
+            if row < 0:
+                raise KeyError(f"Clone {path[-1]} is not in the lineage store.")
+            path.append(int(self.columns["parent"][row]))
+        return path
+
+    def size_history(self):
+        # (days, clone ids, sizes): sizes[d, i] is the size of clone ids[i] on days[d], for
+        # every retained clone that was ever censused.
+        days = np.asarray(self.census_days, dtype=np.int64)
+        clones = np.concatenate(self._census_clones) if self._census_clones else np.empty(0, dtype=np.int32)
+        sizes = np.concatenate(self._census_sizes) if self._census_sizes else np.empty(0, dtype=np.int32)
+        ids, column = np.unique(clones, return_inverse=True)
+        row = np.repeat(np.arange(days.size), np.diff(self.census_offsets))
+        history = np.zeros((days.size, ids.size), dtype=np.int32)
+        history[row, column] = sizes
+        return days, ids, history
+
+    def clone_sizes(self, clone):
+        # (days, sizes) of one clone over every census day (0 while it did not exist).
+        days, ids, history = self.size_history()
+        i = np.searchsorted(ids, clone)
+        if i == ids.size or ids[i] != clone:
+            return days, np.zeros(days.size, dtype=np.int32)
+        return days, history[:, i]
+
+    def pattern_sizes(self, mask):
+        # (days, sizes, clones) of resistance pattern `mask`: its total size per census
+        # day, and how many of its clones were alive that day.
+        days, ids, history = self.size_history()
+        rows = self._rows(ids)
+        of_pattern = self.columns["mask"][rows] == mask
+        return days, history[:, of_pattern].sum(axis=1), (history[:, of_pattern] > 0).sum(axis=1)
+
+    def time_to_origin(self, mask):
+        # Day the first bacterium with exactly resistance pattern `mask` arose, or None.
+        day = int(self.first_origin_day[mask])
+        return day if day >= 0 else None
+
+    def origin_counts(self):
+        # Number of independent mutation events that produced each resistance pattern,
+        # indexed by mask (the inoculum counts once for mask 0).
+        return self.pattern_origins.copy()
+
+    def get_state(self):
+        state = {f"lineage_{name}": column[:self.n_clones] for name, column in self.columns.items()}
+        state["lineage_pattern_origins"] = self.pattern_origins
+        state["lineage_first_origin_day"] = self.first_origin_day
+        state["lineage_census_days"] = np.asarray(self.census_days, dtype=np.int64)
+        state["lineage_census_offsets"] = np.asarray(self.census_offsets, dtype=np.int64)
+        state["lineage_census_clones"] = np.concatenate(self._census_clones) if self._census_clones \
+            else np.empty(0, dtype=np.int32)
+        state["lineage_census_sizes"] = np.concatenate(self._census_sizes) if self._census_sizes \
+            else np.empty(0, dtype=np.int32)
+        state["lineage_live"] = self.live
+        state["lineage_next_id"] = np.asarray(self.next_id)
+        return state
+
+    def set_state(self, state):
+        n = len(state["lineage_clone"])
+        self.columns = {name: np.array(state[f"lineage_{name}"], dtype=dtype) for name, dtype in CLONE_FIELDS}
+        self.n_clones = n
+        self.next_id = int(state["lineage_next_id"])
+        self.pattern_origins = np.array(state["lineage_pattern_origins"], dtype=np.int64)
+        self.first_origin_day = np.array(state["lineage_first_origin_day"], dtype=np.int64)
+        self.census_days = state["lineage_census_days"].tolist()
+        self.census_offsets = state["lineage_census_offsets"].tolist()
+        self._census_clones = [np.array(state["lineage_census_clones"], dtype=np.int32)]
+        self._census_sizes = [np.array(state["lineage_census_sizes"], dtype=np.int32)]
+        self.live = np.array(state["lineage_live"], dtype=np.int32)
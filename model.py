@@ -1,10 +1,49 @@
 from mesa import Model
-from mesa.space import SingleGrid
 from agents import MtbBacterium
+from counters import PopulationCounts
+from mutation import MutationSampler
+from frontier_grid import FrontierGrid
+from numpy_engine import NumpyPopulation
+from tiled_engine import TiledPopulation
+from seeding import sample_initial_cells
+from streams import RandomStream
+from lineage import LineageStore
+from fast_forward import DEFAULT_BLOCK_SIZE, CompartmentPopulation
+from profiling import StepProfiler, profiled_agent_step
+from pharmacodynamics import DRUGS, DRUG_BITS, drug_pd_parameters, kill_probability_table
+from pharmacokinetics import PK_STEPS_PER_DAY, doses_taken, dosing_profile, drug_pk_parameters
 from mesa.datacollection import DataCollector
-from mesa.experimental.devs import ABMSimulator
+import numpy as np
+import json
 import math
 
+SNAPSHOT_VERSION = 2
+SNAPSHOT_ATTRIBUTES = (
+    "initial_persister_fraction",
+    "prob_susceptible_to_persister",
+    "prob_persister_to_susceptible_no_drug",
+    "prob_persister_to_susceptible_drug_on",
+    "replication_prob_per_day",
+    "day_start_treatment",
+    "day_treatment_interval",
+    "active_drugs_config",
+    "active_drug_mask",
+    "running",
+    "pk",
+    "adherence",
+    "miss_persistence",
+    "missed_doses",
+    "dose_hour",
+    "pk_steps_per_day",
+) + tuple(
+    f"{drug.lower()}_{name}"
+    for drug in DRUGS
+    for name in ("k_max_kill_daily", "ec50_ng_ml", "hill_coefficient", "active_concentration_ng_ml",
+                 "absorption_half_life_h", "elimination_half_life_h", "mutation_rate", "drug_on")
+)
+# Key of the child of random_stream that decides which doses are missed.
+DOSING_STREAM = 1
+
 class MtbResistanceModel(Model):
     def __init__(self,
                 drug_type="RIF INH PZA EMB",
@@ -18,15 +57,76 @@ class MtbResistanceModel(Model):
                 prob_persister_to_susceptible_no_drug=0.01,
                 prob_persister_to_susceptible_drug_on=0.0001,
                 seed=None,
-                simulator: ABMSimulator = None,
+                simulator=None,
+                engine="agent",
+                debug_counters=False,
+                seeding="uniform",
+                n_foci=3,
+                focus_radius=None,
+                profile=False,
+                tiles=4,
+                workers=0,
+                pk=False,
+                adherence=1.0,
+                miss_persistence=None,
+                missed_doses=(),
+                dose_hour=8.0,
+                pk_steps_per_day=PK_STEPS_PER_DAY,
+                lineage=False,
+                lineage_prune_every=30,
+                fast_forward=False,
+                fast_forward_block=DEFAULT_BLOCK_SIZE,
                 ):
+        # Every draw of the simulation itself comes from random_stream; Mesa's self.random
+        # only decides the agent update order. seed may also be a SeedSequence from
+        # RandomStream.spawn/child, from which Mesa gets an integer seed.
+        random_stream = RandomStream(seed)
+        if isinstance(seed, np.random.SeedSequence):
+            seed = int(seed.generate_state(1, np.uint64)[0])
         super().__init__(seed=seed)
+        self.random_stream = random_stream
 
+        # The simulator only drives the Solara app; scripts and batch runs call step()
+        # directly and leave it out.
         self.simulator = simulator
-        self.simulator.setup(self)
+        if simulator is not None:
+            simulator.setup(self)
         self.seed = seed
 
-        self.grid = SingleGrid(int(width), int(height), torus=False)
+        if engine not in ("agent", "numpy", "tiled"):
+            raise ValueError(f"Unknown engine '{engine}', expected 'agent', 'numpy' or 'tiled'.")
+        self.engine = engine
+        # Tiles per side (or a (tiles_x, tiles_y) pair) and worker processes of the tiled
+        # engine; results depend on the tiling but not on the number of workers.
+        self.tiles = tiles
+        self.workers = int(workers)
+        self.debug_counters = debug_counters
+        self.profiler = None
+        if profile:
+            self.enable_profiling()
+        self.counts = PopulationCounts()
+        # Opt-in clone lineage (see lineage.py): one row per mutation event, a census of
+        # living clones every day, and extinct clones pruned every lineage_prune_every days.
+        self.lineage = LineageStore() if lineage else None
+        self.lineage_prune_every = int(lineage_prune_every)
+        if fast_forward and lineage:
+            raise ValueError("fast_forward keeps only per-block counts and cannot track lineage.")
+        # With fast_forward, the untreated days before day_start_treatment run on per-block
+        # counts (see fast_forward.py), which become bacteria of the engine at treatment start.
+        self.fast_forward_block = int(fast_forward_block) if fast_forward else None
+        self.compartments = None
+        self.width = int(width)
+        self.height = int(height)
+
+        if self.engine == "numpy":
+            self.grid = None
+            self.population = NumpyPopulation(self, self.width, self.height)
+        elif self.engine == "tiled":
+            self.grid = None
+            self.population = TiledPopulation(self, self.width, self.height, tiles=tiles, workers=self.workers)
+        else:
+            self.grid = FrontierGrid(self.width, self.height, torus=False)
+            self.population = None
         self.steps = 0
 
         self.initial_persister_fraction = initial_persister_fraction
@@ -39,24 +139,32 @@ class MtbResistanceModel(Model):
         self.rif_ec50_ng_ml = 18.4
         self.rif_hill_coefficient = 1.0
         self.rif_active_concentration_ng_ml = 50.0
+        self.rif_absorption_half_life_h = 0.7
+        self.rif_elimination_half_life_h = 3.0
 
         # ISONIAZID (INH)
         self.inh_k_max_kill_daily = 0.041 * 24
         self.inh_ec50_ng_ml = 32.1
         self.inh_hill_coefficient = 1.0
         self.inh_active_concentration_ng_ml = 50.0
+        self.inh_absorption_half_life_h = 0.5
+        self.inh_elimination_half_life_h = 2.5
 
         # PYRAZINAMIDE (PZA)
         self.pza_k_max_kill_daily = 0.043 * 24
         self.pza_ec50_ng_ml = 45.5 * 1000000
         self.pza_hill_coefficient = 1.0
         self.pza_active_concentration_ng_ml = 60000.0
+        self.pza_absorption_half_life_h = 0.8
+        self.pza_elimination_half_life_h = 9.5
 
         # ETHAMBUTOL (EMB)
         self.emb_k_max_kill_daily = 0.053 * 24
         self.emb_ec50_ng_ml = 79.5
         self.emb_hill_coefficient = 1.0
         self.emb_active_concentration_ng_ml = 100.0
+        self.emb_absorption_half_life_h = 1.2
+        self.emb_elimination_half_life_h = 3.5
 
         kg_max_intracellular_hourly = 0.033
         kg_max_intracellular_daily_rate = kg_max_intracellular_hourly * 24
@@ -66,51 +174,70 @@ class MtbResistanceModel(Model):
         self.inh_mutation_rate = 3.2e-7
         self.pza_mutation_rate = 1e-5
         self.emb_mutation_rate = 6.4e-7
+        self.mutation_sampler = MutationSampler(self)
 
         self.rif_drug_on = False
         self.inh_drug_on = False
         self.pza_drug_on = False
         self.emb_drug_on = False
+        self.active_drug_mask = 0
+
+        self._pd_parameters = None
+        self.kill_probability_table = self.get_kill_probability_table()
+        self.kill_probability_today = self.kill_probability_table[0].tolist()
+
+        # With pk, drugs follow absorption/elimination curves of the scheduled doses the
+        # patient actually takes instead of being on at active_concentration_ng_ml on
+        # treatment days; see pharmacokinetics.py.
+        self.pk = bool(pk)
+        self.adherence = float(adherence)
+        self.miss_persistence = miss_persistence
+        self.missed_doses = sorted(int(day) for day in missed_doses)
+        self.dose_hour = float(dose_hour)
+        self.pk_steps_per_day = int(pk_steps_per_day)
+        self._dosing_key = None
+        self.dosing_profile = None
 
         self.day_start_treatment = int(day_start)
         self.day_treatment_interval = int(day_interval)
         self.active_drugs_config = self._parse_drug_type(drug_type)
         initial_mtb = int(initial_mtb)
-        if initial_mtb > self.grid.width * self.grid.height:
-            print(f"Warning: initial_mtb ({initial_mtb}) exceeds SingleGrid capacity ({self.grid.width * self.grid.height}). "
-                f"Setting initial_mtb to {self.grid.width * self.grid.height}.")
-            initial_mtb = self.grid.width * self.grid.height
-
-        for i in range(initial_mtb):
-            is_initial_persister = self.random.random() < self.initial_persister_fraction
-            mtb_agent = MtbBacterium(model=self, initial_is_persister=is_initial_persister)
-            
-            if not self.grid.empties:
-                print(f"Warning: No empty cells left to place all initial MTB. Placed {i} agents.")
-                break
-            
-            empty_cell = self.random.choice(list(self.grid.empties))
-            self.grid.place_agent(mtb_agent, empty_cell)
-            self.agents.add(mtb_agent)
+        if initial_mtb > self.width * self.height:
+            print(f"Warning: initial_mtb ({initial_mtb}) exceeds SingleGrid capacity ({self.width * self.height}). "
+                f"Setting initial_mtb to {self.width * self.height}.")
+            initial_mtb = self.width * self.height
+
+        initial_cells = sample_initial_cells(self.random_stream.generator, self.width, self.height, initial_mtb,
+                                             layout=seeding, n_foci=int(n_foci), focus_radius=focus_radius)
+
+        if self.fast_forward_block is not None:
+            self.compartments = CompartmentPopulation(self.width, self.height, self.fast_forward_block)
+            is_persister = self.random_stream.generator.random(initial_cells.size) < self.initial_persister_fraction
+            x, y = np.divmod(initial_cells, self.height)
+            self.compartments.add(x, y, is_persister, np.zeros(initial_cells.size, dtype=np.uint8))
+            self.counts.apply(self.compartments.histogram())
+        elif self.population is not None:
+            self.population.seed(initial_cells, self.initial_persister_fraction)
+        else:
+            for cell in initial_cells.tolist():
+                is_initial_persister = self.random_stream.random() < self.initial_persister_fraction
+                mtb_agent = MtbBacterium(model=self, initial_is_persister=is_initial_persister)
+                self.grid.place_agent(mtb_agent, divmod(cell, self.height))
+                self.agents.add(mtb_agent)
+                self.counts.add(mtb_agent.resistance_mask, mtb_agent.is_persister)
 
         model_reporters = {
-            "Total Mtb": lambda m: len(m.agents),
-            "Susceptible": lambda m: len(m.agents.select(
-                lambda a: a.is_persister==False
-                            and a.resistance_profile["RIF"]==False
-                            and a.resistance_profile["INH"]==False
-                            and a.resistance_profile["PZA"]==False
-                            and a.resistance_profile["EMB"]==False
-                            )),
-            "Persister": lambda m: len(m.agents.select(lambda a: a.is_persister)),
-            "Res-RIF": lambda m: len(m.agents.select(lambda a: a.resistance_profile["RIF"])),
-            "Res-INH": lambda m: len(m.agents.select(lambda a: a.resistance_profile["INH"])),
-            "Res-PZA": lambda m: len(m.agents.select(lambda a: a.resistance_profile["PZA"])),
-            "Res-EMB": lambda m: len(m.agents.select(lambda a: a.resistance_profile["EMB"])),
+            "Total Mtb": lambda m: m.counts.total(),
+            "Susceptible": lambda m: m.counts.susceptible(),
+            "Persister": lambda m: m.counts.persisters(),
         }
+        for drug in DRUGS:
+            model_reporters[f"Res-{drug}"] = lambda m, drug=drug: m.counts.resistant(drug)
         self.datacollector = DataCollector(model_reporters)
         self.running = True
         self.datacollector.collect(self)
+        if self.lineage is not None:
+            self.lineage.census(self.steps, self.get_clone_ids())
 
 
     def _parse_drug_type(self, drug_type_input):
@@ -129,31 +256,270 @@ class MtbResistanceModel(Model):
         return active_drugs_map
 
 
+    def get_kill_probability_table(self):
+        # Rebuilt only when a drug's k_max, EC50, Hill coefficient or concentration changed.
+        pd_parameters = drug_pd_parameters(self)
+        if pd_parameters != self._pd_parameters:
+            self._pd_parameters = pd_parameters
+            self.kill_probability_table = kill_probability_table(pd_parameters)
+        return self.kill_probability_table
+
+    def get_dosing_profile(self, n_days):
+        # (active_masks, kill_probability) per day, covering at least days 0..n_days-1.
+        # Rebuilt when a PK/PD parameter, the regimen or the adherence settings changed,
+        # and with twice the horizon when the run outgrows it; each step then only reads
+        # its day's row.
+        key = (drug_pd_parameters(self), drug_pk_parameters(self), tuple(sorted(self.active_drugs_config.items())),
+               self.day_start_treatment, self.day_treatment_interval, self.adherence, self.miss_persistence,
+               tuple(self.missed_doses), self.dose_hour, self.pk_steps_per_day)
+        horizon = len(self.dosing_profile[0]) if self.dosing_profile is not None else 0
+        if key != self._dosing_key or horizon < n_days:
+            horizon = max(n_days, 2 * horizon, 64)
+            dose_days = list(range(max(self.day_start_treatment, 0), horizon, max(self.day_treatment_interval, 1)))
+            rng = self.random_stream.child(DOSING_STREAM).generator
+            taken = doses_taken(dose_days, self.adherence, self.miss_persistence, self.missed_doses, rng)
+            active_mask = sum(DRUG_BITS[drug] for drug, active in self.active_drugs_config.items() if active)
+            self.dosing_profile = dosing_profile(drug_pd_parameters(self), drug_pk_parameters(self), active_mask,
+                                                 dose_days, taken, horizon, self.dose_hour, self.pk_steps_per_day)
+            self._dosing_key = key
+        return self.dosing_profile
+
+    def recount(self):
+        if self.compartments is not None:
+            return PopulationCounts(self.compartments.histogram().tolist())
+        if self.population is not None:
+            return self.population.recount()
+        return PopulationCounts.from_agents(self.agents)
+
+    def check_counters(self):
+        recounted = self.recount()
+        if recounted != self.counts:
+            raise RuntimeError(f"Population counters drifted on day {self.steps}: "
+                               f"tracked {self.counts}, recounted {recounted}")
+
+    def enable_profiling(self):
+        # Per-phase wall time and event counts, per step and cumulative; see profiling.py.
+        # When profiling is off, step() runs the plain code path with no timing calls.
+        if self.profiler is None:
+            self.profiler = StepProfiler()
+        return self.profiler
+
+    def set_treatment(self, drug_type=None, day_start=None, day_interval=None):
+        # Changes the regimen of an existing model, e.g. to fork scenarios from a snapshot.
+        if drug_type is not None:
+            self.active_drugs_config = self._parse_drug_type(drug_type)
+        if day_start is not None:
+            self.day_start_treatment = int(day_start)
+        if day_interval is not None:
+            self.day_treatment_interval = int(day_interval)
+
+    def get_population_arrays(self):
+        # (x, y, is_persister, resistance_mask) in update order. For the agent engine that is
+        # AgentSet order, which shuffle_do depends on. While fast-forwarding, a deterministic
+        # layout of the block counts.
+        if self.compartments is not None:
+            return self.compartments.materialize()
+        if self.population is not None:
+            population = self.population
+            return population.x, population.y, population.is_persister, population.resistance
+        agents = list(self.agents)
+        return (
+            np.array([agent.pos[0] for agent in agents], dtype=np.int32),
+            np.array([agent.pos[1] for agent in agents], dtype=np.int32),
+            np.array([agent.is_persister for agent in agents], dtype=bool),
+            np.array([agent.resistance_mask for agent in agents], dtype=np.uint8),
+        )
+
+    def get_clone_ids(self):
+        # Lineage clone id of every bacterium, in the order of get_population_arrays.
+        if self.population is not None:
+            return self.population.clone
+        return np.fromiter((agent.clone for agent in self.agents), dtype=np.int32, count=len(self.agents))
+
+    def _restore_population(self, x, y, is_persister, resistance, clone=None):
+        if self.population is not None:
+            self.population.restore(x, y, is_persister, resistance, clone)
+            return
+        if clone is None:
+            clone = np.zeros(len(x), dtype=np.int32)
+        for agent_x, agent_y, agent_is_persister, agent_mask, agent_clone in zip(
+                x.tolist(), y.tolist(), is_persister.tolist(), resistance.tolist(), clone.tolist()):
+            agent = MtbBacterium(model=self, resistance_mask=agent_mask, initial_is_persister=agent_is_persister,
+                                 clone=agent_clone)
+            self.grid.place_agent(agent, (agent_x, agent_y))
+            self.agents.add(agent)
+            self.counts.add(agent_mask, agent_is_persister)
+
+    def _end_fast_forward(self):
+        # Turns the block counts into bacteria of the engine.
+        x, y, is_persister, resistance = self.compartments.materialize(self.random_stream.generator)
+        self.compartments = None
+        self.counts = PopulationCounts()
+        self._restore_population(x, y, is_persister, resistance)
+
+    def save_snapshot(self, path):
+        random_version, random_internal, random_gauss = self.random.getstate()
+        metadata = {
+            "version": SNAPSHOT_VERSION,
+            "engine": self.engine,
+            "width": self.width,
+            "height": self.height,
+            "seed": self.seed,
+            # The full seed: child streams such as the dosing stream derive from it, and a
+            # SeedSequence seed (e.g. from sweep --root-seed) is more than the int in "seed".
+            "seed_sequence": {"entropy": np.asarray(self.random_stream.seed_sequence.entropy).tolist(),
+                              "spawn_key": list(self.random_stream.seed_sequence.spawn_key)},
+            "steps": self.steps,
+            "tiles": self.tiles,
+            "lineage": self.lineage is not None,
+            "lineage_prune_every": self.lineage_prune_every,
+            "fast_forward_block": self.fast_forward_block,
+            "attributes": {name: getattr(self, name) for name in SNAPSHOT_ATTRIBUTES},
+            "random_state": [random_version, list(random_internal), random_gauss],
+            "rng_state": self.rng.bit_generator.state,
+            "random_stream_state": self.random_stream.get_state(),
+            "mutation_sampler_state": self.mutation_sampler.get_state(),
+            "model_vars": self.datacollector.model_vars,
+        }
+        extra_arrays = {}
+        if self.compartments is not None:
+            # Still fast-forwarding: the block counts are the whole population.
+            x, y, is_persister, resistance = (np.empty(0, dtype=dtype) for dtype in (np.int32, np.int32, bool, np.uint8))
+            extra_arrays["compartments"] = self.compartments.counts
+        else:
+            x, y, is_persister, resistance = self.get_population_arrays()
+        if self.lineage is not None:
+            extra_arrays.update(self.lineage.get_state(), clone=self.get_clone_ids())
+        np.savez_compressed(path, metadata=np.array(json.dumps(metadata)),
+                            x=x, y=y, is_persister=is_persister, resistance=resistance, **extra_arrays)
+
+    @classmethod
+    def load_snapshot(cls, path, simulator=None, workers=0, **treatment):
+        # Resumes exactly where save_snapshot left off; stepping the result gives the same
+        # trajectory as the uninterrupted run. workers is a run option like simulator (the
+        # trajectory does not depend on it), so it is not stored in the snapshot. Other
+        # keyword arguments go to set_treatment, so one pre-treatment snapshot can be forked
+        # into several regimens.
+        with np.load(path) as data:
+            metadata = json.loads(str(data["metadata"]))
+            x, y = data["x"], data["y"]
+            is_persister, resistance = data["is_persister"], data["resistance"]
+            lineage_arrays = {name: data[name] for name in data.files if name.startswith("lineage_")}
+            clone = data["clone"] if "clone" in data.files else None
+            compartments = data["compartments"] if "compartments" in data.files else None
+        if metadata["version"] != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {metadata['version']} in {path}.")
+
+        seed = metadata["seed"]
+        seed_sequence = metadata.get("seed_sequence")
+        if seed_sequence is not None and (seed_sequence["spawn_key"] or seed_sequence["entropy"] != seed):
+            # Seeded with a SeedSequence (or unseeded): rebuild the same sequence.
+            seed = np.random.SeedSequence(seed_sequence["entropy"], spawn_key=tuple(seed_sequence["spawn_key"]))
+        model = cls(width=metadata["width"], height=metadata["height"], engine=metadata["engine"],
+                    initial_mtb=0, seed=seed, simulator=simulator, tiles=metadata.get("tiles", 4),
+                    workers=workers,
+                    lineage=metadata.get("lineage", False),
+                    lineage_prune_every=metadata.get("lineage_prune_every", 30),
+                    fast_forward=metadata.get("fast_forward_block") is not None,
+                    fast_forward_block=metadata.get("fast_forward_block") or DEFAULT_BLOCK_SIZE)
+        for name, value in metadata["attributes"].items():
+            setattr(model, name, value)
+        model.steps = metadata["steps"]
+        model._restore_population(x, y, is_persister, resistance, clone)
+        if compartments is not None:
+            model.compartments.restore(compartments)
+            model.counts.apply(model.compartments.histogram())
+        else:
+            model.compartments = None
+        if model.lineage is not None:
+            model.lineage.set_state(lineage_arrays)
+
+        random_version, random_internal, random_gauss = metadata["random_state"]
+        model.random.setstate((random_version, tuple(random_internal), random_gauss))
+        model.rng.bit_generator.state = metadata["rng_state"]
+        model.random_stream.set_state(metadata["random_stream_state"])
+        model.mutation_sampler.set_state(metadata["mutation_sampler_state"])
+        model.datacollector.model_vars = metadata["model_vars"]
+        if model.pk:
+            model.kill_probability_today = model.get_dosing_profile(model.steps + 1)[1][model.steps].tolist()
+        else:
+            model.kill_probability_today = model.get_kill_probability_table()[model.active_drug_mask].tolist()
+
+        model.set_treatment(**treatment)
+        return model
+
     def step(self):
-        is_treatment_day = False
-        if self.steps >= self.day_start_treatment:
-            if (self.steps - self.day_start_treatment) % self.day_treatment_interval == 0:
-                is_treatment_day = True
+        if self.compartments is not None and self.steps >= self.day_start_treatment:
+            self._end_fast_forward()
 
-        administered_today_list = []
-        if is_treatment_day:
-            self.rif_drug_on = self.active_drugs_config.get("RIF", False)
-            if self.rif_drug_on: administered_today_list.append("RIF")
+        if self.compartments is not None:
+            # An untreated day.
+            for drug in DRUGS:
+                setattr(self, f"{drug.lower()}_drug_on", False)
+            self.active_drug_mask = 0
+            self.kill_probability_today = self.get_kill_probability_table()[0].tolist()
+        elif self.pk:
+            # Today's row of the precomputed dosing profile.
+            active_masks, kill_probability = self.get_dosing_profile(self.steps + 1)
+            self.active_drug_mask = int(active_masks[self.steps])
+            for drug in DRUGS:
+                setattr(self, f"{drug.lower()}_drug_on", bool(self.active_drug_mask & DRUG_BITS[drug]))
+            self.kill_probability_today = kill_probability[self.steps].tolist()
+        else:
+            is_treatment_day = False
+            if self.steps >= self.day_start_treatment:
+                if (self.steps - self.day_start_treatment) % self.day_treatment_interval == 0:
+                    is_treatment_day = True
+
+            administered_today_list = []
+            if is_treatment_day:
+                self.rif_drug_on = self.active_drugs_config.get("RIF", False)
+                if self.rif_drug_on: administered_today_list.append("RIF")
+
+                self.inh_drug_on = self.active_drugs_config.get("INH", False)
+                if self.inh_drug_on: administered_today_list.append("INH")
+
+                self.pza_drug_on = self.active_drugs_config.get("PZA", False)
+                if self.pza_drug_on: administered_today_list.append("PZA")
 
-            self.inh_drug_on = self.active_drugs_config.get("INH", False)
-            if self.inh_drug_on: administered_today_list.append("INH")
+                self.emb_drug_on = self.active_drugs_config.get("EMB", False)
+                if self.emb_drug_on: administered_today_list.append("EMB")
 
-            self.pza_drug_on = self.active_drugs_config.get("PZA", False)
-            if self.pza_drug_on: administered_today_list.append("PZA")
+            else:
+                self.rif_drug_on = False
+                self.inh_drug_on = False
+                self.pza_drug_on = False
+                self.emb_drug_on = False
 
-            self.emb_drug_on = self.active_drugs_config.get("EMB", False)
-            if self.emb_drug_on: administered_today_list.append("EMB")
+            self.active_drug_mask = sum(DRUG_BITS[drug] for drug in administered_today_list)
+            self.kill_probability_today = self.get_kill_probability_table()[self.active_drug_mask].tolist()
+        self.mutation_sampler.refresh()
 
+        profiler = self.profiler
+        if profiler is not None:
+            profiler.start_step()
+
+        if self.compartments is not None:
+            self.compartments.step(self)
+            self.counts = PopulationCounts(self.compartments.histogram().tolist())
+        elif self.population is not None:
+            self.population.step()
+        elif profiler is not None:
+            self.agents.shuffle_do(profiled_agent_step, profiler)
         else:
-            self.rif_drug_on = False
-            self.inh_drug_on = False
-            self.pza_drug_on = False
-            self.emb_drug_on = False
+            self.agents.shuffle_do("step")
+
+        if self.lineage is not None:
+            self.lineage.census(self.steps, self.get_clone_ids())
+            if self.lineage_prune_every and self.steps % self.lineage_prune_every == 0:
+                self.lineage.prune()
 
-        self.agents.shuffle_do("step")
-        self.datacollector.collect(self)
\ No newline at end of file
+        if self.debug_counters:
+            self.check_counters()
+
+        if profiler is not None:
+            with profiler.phase("data_collection"):
+                self.datacollector.collect(self)
+            profiler.end_step()
+        else:
+            self.datacollector.collect(self)
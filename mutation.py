@@ -0,0 +1,78 @@
+from pharmacodynamics import DRUGS
+import math
+
+N_DRUGS = len(DRUGS)
+
+
+class MutationSampler:
+    # Skip-ahead replacement for one Bernoulli(mutation_rate) draw per drug per replication.
+    #
+    # For each drug we draw the geometric number of eligible replications (parent not yet
+    # resistant to that drug) until the next mutation, and count eligible replications down
+    # to it. Replications from fully susceptible parents are eligible for every drug, so
+    # they share one counter: drug i mutates when shared == thresholds[i]. A replication
+    # from a partly resistant parent only counts for the drugs it is still susceptible to,
+    # which is done by moving those drugs' thresholds one step closer.
+    #
+    # Every eligible replication still mutates with exactly probability mutation_rate
+    # (the geometric distribution is memoryless), but replications that do not mutate
+    # draw no random numbers.
+    def __init__(self, model):
+        self.model = model
+        self.shared = 0
+        self.rates = self._current_rates()
+        self.thresholds = [self._gap(rate) for rate in self.rates]
+        self.next_threshold = min(self.thresholds)
+
+    def _current_rates(self):
+        return tuple(getattr(self.model, f"{drug.lower()}_mutation_rate") for drug in DRUGS)
+
+    def _gap(self, rate):
+        if rate <= 0.0:
+            return math.inf
+        if rate >= 1.0:
+            return 1
+        u = 1.0 - self.model.random_stream.random()
+        return int(math.log(u) / math.log1p(-rate)) + 1
+
+    def refresh(self):
+        # Redraws the gap of any drug whose mutation rate was changed since the last call.
+        rates = self._current_rates()
+        if rates == self.rates:
+            return
+        for i, rate in enumerate(rates):
+            if rate != self.rates[i]:
+                self.thresholds[i] = self.shared + self._gap(rate)
+        self.rates = rates
+        self.next_threshold = min(self.thresholds)
+
+    def sample(self, parent_mask):
+        # Resistance mask of a child of a parent with parent_mask.
+        if not parent_mask:
+            self.shared += 1
+            if self.shared < self.next_threshold:
+                return 0
+
+        child_mask = parent_mask
+        thresholds = self.thresholds
+        for i in range(N_DRUGS):
+            bit = 1 << i
+            if parent_mask & bit:
+                continue
+            if parent_mask:
+                thresholds[i] -= 1
+            if thresholds[i] == self.shared:
+                child_mask |= bit
+                thresholds[i] += self._gap(self.rates[i])
+        self.next_threshold = min(thresholds)
+        return child_mask
+
+    def get_state(self):
+        return {"shared": self.shared, "rates": list(self.rates), "thresholds": list(self.thresholds)}
+
+    def set_state(self, state):
+        self.shared = state["shared"]
+        self.rates = tuple(state["rates"])
+        self.thresholds = list(state["thresholds"])
+        self.next_threshold = min(self.thresholds)
+
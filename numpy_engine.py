@@ -0,0 +1,243 @@
+from counters import N_PATTERNS, PopulationCounts
+from pharmacodynamics import DRUGS
+from contextlib import nullcontext
+import numpy as np
+
+MOORE_DX = np.array([-1, -1, -1, 0, 0, 1, 1, 1], dtype=np.int64)
+MOORE_DY = np.array([-1, 0, 1, -1, 1, -1, 0, 1], dtype=np.int64)
+
+
+def _untimed(phase):
+    return nullcontext()
+
+
+class NumpyPopulation:
+    # Struct-of-arrays population used by MtbResistanceModel(engine="numpy").
+    # Resistance is a bitmask with bit i set when resistant to DRUGS[i].
+    def __init__(self, model, width, height):
+        self.model = model
+        self.width = int(width)
+        self.height = int(height)
+
+        self.x = np.empty(0, dtype=np.int32)
+        self.y = np.empty(0, dtype=np.int32)
+        self.is_persister = np.empty(0, dtype=bool)
+        self.resistance = np.empty(0, dtype=np.uint8)
+        self.clone = np.empty(0, dtype=np.int32)
+        self.occupied = np.zeros((self.width, self.height), dtype=bool)
+
+    def __len__(self):
+        return self.x.size
+
+    def seed(self, cells, initial_persister_fraction):
+        initial_mtb = cells.size
+        self.x = (cells // self.height).astype(np.int32)
+        self.y = (cells % self.height).astype(np.int32)
+        self.is_persister = self.model.random_stream.generator.random(initial_mtb) < initial_persister_fraction
+        self.resistance = np.zeros(initial_mtb, dtype=np.uint8)
+        self.clone = np.zeros(initial_mtb, dtype=np.int32)
+        self.occupied[self.x, self.y] = True
+        self.model.counts.apply(self.pattern_delta(slice(None)))
+
+    def restore(self, x, y, is_persister, resistance, clone=None):
+        self.x = np.asarray(x, dtype=np.int32)
+        self.y = np.asarray(y, dtype=np.int32)
+        self.is_persister = np.asarray(is_persister, dtype=bool)
+        self.resistance = np.asarray(resistance, dtype=np.uint8)
+        self.clone = np.zeros(self.x.size, dtype=np.int32) if clone is None else np.asarray(clone, dtype=np.int32)
+        self.occupied[:] = False
+        self.occupied[self.x, self.y] = True
+        self.model.counts.apply(self.pattern_delta(slice(None)))
+
+    def pattern_delta(self, selected):
+        # Histogram (indexed like PopulationCounts) of the selected bacteria.
+        keys = self.resistance[selected].astype(np.int64) << 1 | self.is_persister[selected]
+        return np.bincount(keys, minlength=N_PATTERNS)
+
+    def recount(self):
+        return PopulationCounts(self.pattern_delta(slice(None)).tolist())
+
+    def _keep(self, keep):
+        self.x = self.x[keep]
+        self.y = self.y[keep]
+        self.is_persister = self.is_persister[keep]
+        self.resistance = self.resistance[keep]
+        self.clone = self.clone[keep]
+
+    def _switch_phenotype(self, any_drug_on):
+        model = self.model
+        u = model.random_stream.generator.random(self.x.size)
+        persister = self.is_persister
+
+        if any_drug_on:
+            to_persister = ~persister & (u < model.prob_susceptible_to_persister)
+            to_susceptible = persister & (u < model.prob_persister_to_susceptible_drug_on)
+        else:
+            to_persister = np.zeros_like(persister)
+            to_susceptible = persister & (u < model.prob_persister_to_susceptible_no_drug)
+
+        switched = to_persister | to_susceptible
+        n_switched = int(np.count_nonzero(switched))
+        if n_switched:
+            before = self.pattern_delta(switched)
+            self.is_persister = persister ^ switched
+            model.counts.apply(self.pattern_delta(switched) - before)
+        return n_switched
+
+    def _draw_kills(self):
+        if not self.model.active_drug_mask:
+            return np.zeros(self.x.size, dtype=bool)
+        kill_probability = np.asarray(self.model.kill_probability_today)[self.resistance]
+        kill_probability[self.is_persister] = 0.0
+        return self.model.random_stream.generator.random(self.x.size) < kill_probability
+
+    def _remove(self, killed, rank):
+        if not killed.any():
+            return rank, None
+
+        # A freed cell only becomes available to agents updated after the one that died in it.
+        freed_at_rank = np.full((self.width, self.height), -1, dtype=np.int64)
+        freed_at_rank[self.x[killed], self.y[killed]] = rank[killed]
+        self.occupied[self.x[killed], self.y[killed]] = False
+        self.model.counts.apply(-self.pattern_delta(killed))
+        self._keep(~killed)
+        return rank[~killed], freed_at_rank
+
+    def _count_blocked(self):
+        # Replicating bacteria whose Moore neighbours are all occupied or off-grid.
+        padded = np.ones((self.width + 2, self.height + 2), dtype=bool)
+        padded[1:-1, 1:-1] = self.occupied
+        empty_neighbors = sum(
+            ~padded[1 + dx:self.width + 1 + dx, 1 + dy:self.height + 1 + dy]
+            for dx, dy in zip(MOORE_DX.tolist(), MOORE_DY.tolist())
+        )
+        return int(np.count_nonzero(~self.is_persister & (empty_neighbors[self.x, self.y] == 0)))
+
+    def _mutate(self, parent_resistance):
+        # Per drug, the number of mutants among eligible parents is Binomial(eligible, rate)
+        # and they are a uniform subset, so only mutating parents cost a draw.
+        model = self.model
+        rng = model.random_stream.generator
+        child_resistance = parent_resistance.copy()
+        for i, drug in enumerate(DRUGS):
+            bit = np.uint8(1 << i)
+            rate = getattr(model, f"{drug.lower()}_mutation_rate")
+            eligible = np.flatnonzero((parent_resistance & bit) == 0)
+            n_mutants = rng.binomial(eligible.size, rate) if eligible.size else 0
+            if n_mutants:
+                child_resistance[rng.choice(eligible, size=n_mutants, replace=False)] |= bit
+        return child_resistance
+
+    def _replicate(self, rank, freed_at_rank):
+        # Returns the x, y, resistance, parent resistance and clone of every child that
+        # found a cell.
+        model = self.model
+        rng = model.random_stream.generator
+
+        replicating = ~self.is_persister & (rng.random(self.x.size) < model.replication_prob_per_day)
+        parents = np.flatnonzero(replicating)
+        if parents.size == 0:
+            return None
+
+        # Parents are processed in update order, so earlier parents win contested cells.
+        parents = parents[np.argsort(rank[parents])]
+        parent_rank = rank[parents]
+        parent_x = self.x[parents].astype(np.int64)
+        parent_y = self.y[parents].astype(np.int64)
+        parent_resistance = self.resistance[parents]
+        child_resistance = self._mutate(parent_resistance)
+        parent_clone = self.clone[parents]
+
+        new_x, new_y, new_resistance, new_parent_resistance, new_clone = [], [], [], [], []
+        pending = np.arange(parents.size)
+        while pending.size:
+            nx = parent_x[pending, None] + MOORE_DX
+            ny = parent_y[pending, None] + MOORE_DY
+            empty = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+            empty[empty] = ~self.occupied[nx[empty], ny[empty]]
+            if freed_at_rank is not None:
+                later = np.broadcast_to(parent_rank[pending, None], nx.shape)
+                empty[empty] = freed_at_rank[nx[empty], ny[empty]] < later[empty]
+
+            n_empty = empty.sum(axis=1)
+            has_room = n_empty > 0
+            if not has_room.any():
+                break
+            pending, nx, ny, empty, n_empty = (
+                pending[has_room], nx[has_room], ny[has_room], empty[has_room], n_empty[has_room]
+            )
+
+            pick = (rng.random(pending.size) * n_empty).astype(np.int64)
+            column = np.argmax(np.cumsum(empty, axis=1) > pick[:, None], axis=1)
+            rows = np.arange(pending.size)
+            target_x = nx[rows, column]
+            target_y = ny[rows, column]
+
+            _, first = np.unique(target_x * self.height + target_y, return_index=True)
+            won = np.zeros(pending.size, dtype=bool)
+            won[first] = True
+
+            self.occupied[target_x[won], target_y[won]] = True
+            new_x.append(target_x[won])
+            new_y.append(target_y[won])
+            new_resistance.append(child_resistance[pending[won]])
+            new_parent_resistance.append(parent_resistance[pending[won]])
+            new_clone.append(parent_clone[pending[won]])
+            pending = pending[~won]
+
+        if not new_x:
+            return None
+        born = (
+            np.concatenate(new_x).astype(np.int32),
+            np.concatenate(new_y).astype(np.int32),
+            np.concatenate(new_resistance),
+            np.concatenate(new_parent_resistance),
+            np.concatenate(new_clone),
+        )
+        if model.lineage is not None:
+            # Every placed mutant founds a new clone.
+            mutated = np.flatnonzero(born[2] != born[3])
+            if mutated.size:
+                born[4][mutated] = model.lineage.record_many(born[4][mutated], born[3][mutated], born[2][mutated],
+                                                             model.steps)
+        return born
+
+    def _append(self, born_x, born_y, born_resistance, born_clone):
+        self.x = np.concatenate([self.x, born_x])
+        self.y = np.concatenate([self.y, born_y])
+        self.is_persister = np.concatenate([self.is_persister, np.zeros(born_x.size, dtype=bool)])
+        self.resistance = np.concatenate([self.resistance, born_resistance])
+        self.clone = np.concatenate([self.clone, born_clone])
+        self.model.counts.apply(np.bincount(born_resistance.astype(np.int64) << 1, minlength=N_PATTERNS))
+
+    def step(self):
+        if self.x.size == 0:
+            return
+
+        profiler = self.model.profiler
+        phase = profiler.phase if profiler is not None else _untimed
+
+        # A random update rank per agent stands in for the shuffle_do order of the agent engine.
+        rank = self.model.random_stream.generator.permutation(self.x.size)
+        with phase("switching"):
+            n_switched = self._switch_phenotype(bool(self.model.active_drug_mask))
+        with phase("killing"):
+            killed = self._draw_kills()
+        with phase("agent_set"):
+            rank, freed_at_rank = self._remove(killed, rank)
+        if profiler is not None:
+            n_blocked = self._count_blocked()
+        with phase("replication"):
+            born = self._replicate(rank, freed_at_rank)
+        if born is not None:
+            with phase("agent_set"):
+                self._append(born[0], born[1], born[2], born[4])
+
+        if profiler is not None:
+            events = profiler.current.events
+            events["switches"] += n_switched
+            events["deaths"] += int(np.count_nonzero(killed))
+            events["blocked_replications"] += n_blocked
+            if born is not None:
+                events["births"] += born[0].size
+                events["mutations"] += int(np.count_nonzero(born[2] != born[3]))
@@ -0,0 +1,48 @@
+from functools import lru_cache
+import numpy as np
+import math
+
+DRUGS = ("RIF", "INH", "PZA", "EMB")
+DRUG_BITS = {drug: 1 << i for i, drug in enumerate(DRUGS)}
+N_MASKS = 1 << len(DRUGS)
+
+
+def hill_kill_rate(k_max_kill_daily, ec50_ng_ml, hill_coefficient, concentration_ng_ml):
+    conc_pow_hill = math.pow(concentration_ng_ml, hill_coefficient)
+    ec50_pow_hill = math.pow(ec50_ng_ml, hill_coefficient)
+
+    if (ec50_pow_hill + conc_pow_hill) == 0:
+        return 0.0
+    return k_max_kill_daily * (conc_pow_hill / (ec50_pow_hill + conc_pow_hill))
+
+
+def drug_pd_parameters(model):
+    # (k_max, EC50, Hill coefficient, concentration) per drug, in DRUGS order.
+    parameters = []
+    for drug in DRUGS:
+        drug_lower = drug.lower()
+        parameters.append((
+            getattr(model, f"{drug_lower}_k_max_kill_daily"),
+            getattr(model, f"{drug_lower}_ec50_ng_ml"),
+            getattr(model, f"{drug_lower}_hill_coefficient"),
+            getattr(model, f"{drug_lower}_active_concentration_ng_ml"),
+        ))
+    return tuple(parameters)
+
+
+@lru_cache(maxsize=256)
+def kill_probability_table(pd_parameters):
+    # table[active_mask, resistance_mask] is the daily kill probability of a replicating
+    # bacterium: 1 - exp(-max rate over active drugs it is not resistant to).
+    rates = [hill_kill_rate(*drug_parameters) for drug_parameters in pd_parameters]
+
+    table = np.zeros((N_MASKS, N_MASKS))
+    for active_mask in range(N_MASKS):
+        for resistance_mask in range(N_MASKS):
+            effective = active_mask & ~resistance_mask
+            max_rate = max((rate for i, rate in enumerate(rates) if effective & (1 << i)), default=0.0)
+            table[active_mask, resistance_mask] = 1.0 - math.exp(-max_rate)
+
+    table = np.clip(table, 0.0, 1.0)
+    table.setflags(write=False)
+    return table
@@ -0,0 +1,106 @@
+from pharmacodynamics import DRUGS, N_MASKS
+import numpy as np
+import math
+
+# Default sampling of the concentration curves, per day.
+PK_STEPS_PER_DAY = 24
+# A drug counts as present on a day (for drug_on, active_drug_mask and phenotype
+# switching) when its concentration reaches this fraction of its dose peak that day.
+PRESENCE_FRACTION = 0.01
+
+
+def drug_pk_parameters(model):
+    # (absorption half-life h, elimination half-life h, peak concentration) per drug, in
+    # DRUGS order. The peak of a single dose is the drug's active concentration.
+    parameters = []
+    for drug in DRUGS:
+        drug_lower = drug.lower()
+        parameters.append((
+            getattr(model, f"{drug_lower}_absorption_half_life_h"),
+            getattr(model, f"{drug_lower}_elimination_half_life_h"),
+            getattr(model, f"{drug_lower}_active_concentration_ng_ml"),
+        ))
+    return tuple(parameters)
+
+
+def dose_response(absorption_half_life_h, elimination_half_life_h, peak_ng_ml, hours):
+    # Concentration `hours` after one oral dose (one-compartment model, first-order
+    # absorption and elimination), scaled so that the curve peaks at peak_ng_ml.
+    ka = math.log(2) / absorption_half_life_h
+    ke = math.log(2) / elimination_half_life_h
+    if math.isclose(ka, ke):
+        ka *= 1.0 + 1e-6
+    t_max = math.log(ka / ke) / (ka - ke)
+    peak = math.exp(-ke * t_max) - math.exp(-ka * t_max)
+    hours = np.asarray(hours, dtype=float)
+    curve = np.where(hours >= 0, np.exp(-ke * np.maximum(hours, 0)) - np.exp(-ka * np.maximum(hours, 0)), 0.0)
+    return peak_ng_ml * curve / peak
+
+
+def doses_taken(dose_days, adherence, miss_persistence, missed_doses, rng):
+    # Which scheduled doses the patient takes. Misses follow a two-state Markov chain that
+    # takes `adherence` of the doses in the long run; miss_persistence is the probability
+    # that a missed dose is followed by another miss (None: misses are independent), so
+    # larger values give longer gaps at the same adherence. Days in missed_doses are
+    # always missed, and the chain moves on from them as from any other miss.
+    miss_fraction = 1.0 - adherence
+    if miss_persistence is None or miss_fraction <= 0.0 or miss_fraction >= 1.0:
+        miss_after_taken = miss_after_missed = miss_fraction
+    else:
+        miss_after_missed = miss_persistence
+        miss_after_taken = min(1.0, miss_fraction * (1.0 - miss_persistence) / adherence)
+
+    u = rng.random(len(dose_days))
+    taken = np.ones(len(dose_days), dtype=bool)
+    missed = miss_fraction >= 1.0
+    forced = set(missed_doses)
+    for i, day in enumerate(dose_days):
+        missed = u[i] < (miss_after_missed if missed else miss_after_taken) or day in forced
+        taken[i] = not missed
+    return taken
+
+
+def dosing_profile(pd_parameters, pk_parameters, active_mask, dose_days, taken, n_days,
+                   dose_hour=8.0, steps_per_day=PK_STEPS_PER_DAY):
+    # Returns (active_masks, kill_probability): for each day d < n_days, the mask of drugs
+    # present that day and the probability, per resistance mask, that a replicating
+    # bacterium is killed during it. The concentration of every drug in active_mask is
+    # the sum of its taken doses, sampled steps_per_day times a day; at each sample the
+    # kill rate against a bacterium is the largest Hill rate of the drugs it is not
+    # resistant to, and a day's kill probability is 1 - exp(-mean rate over the day).
+    dt_h = 24.0 / steps_per_day
+    hours = (np.arange(n_days * steps_per_day) + 0.5) * dt_h
+    dose_hours = np.asarray(dose_days, dtype=float)[np.asarray(taken, dtype=bool)] * 24.0 + dose_hour
+
+    n_drugs = len(DRUGS)
+    rates = np.zeros((n_drugs, hours.size))
+    present = np.zeros((n_drugs, n_days), dtype=bool)
+    for i, ((k_max, ec50, hill, _), (absorption, elimination, peak)) in enumerate(zip(pd_parameters, pk_parameters)):
+        if not active_mask & (1 << i) or dose_hours.size == 0:
+            continue
+        # A dose is negligible 30 half-lives after it was taken.
+        span = int(math.ceil(30 * max(absorption, elimination) / dt_h)) + 1
+        concentration = np.zeros(hours.size)
+        for start in dose_hours:
+            first = int(start // dt_h)
+            if first < hours.size:
+                last = min(first + span, hours.size)
+                concentration[first:last] += dose_response(absorption, elimination, peak, hours[first:last] - start)
+        daily_peak = concentration.reshape(n_days, steps_per_day).max(axis=1)
+        present[i] = daily_peak >= PRESENCE_FRACTION * peak
+        conc_pow_hill = np.power(concentration, hill)
+        ec50_pow_hill = math.pow(ec50, hill)
+        rates[i] = k_max * conc_pow_hill / (ec50_pow_hill + conc_pow_hill)
+
+    active_masks = (present.astype(np.int64) << np.arange(n_drugs)[:, None]).sum(axis=0)
+    kill_probability = np.zeros((n_days, N_MASKS))
+    for resistance_mask in range(N_MASKS):
+        effective = [i for i in range(n_drugs) if not resistance_mask & (1 << i)]
+        if not effective:
+            continue
+        daily_rate = rates[effective].max(axis=0).reshape(n_days, steps_per_day).mean(axis=1)
+        kill_probability[:, resistance_mask] = 1.0 - np.exp(-daily_rate)
+
+    active_masks.setflags(write=False)
+    kill_probability.setflags(write=False)
+    return active_masks, kill_probability
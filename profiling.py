@@ -0,0 +1,99 @@
+from contextlib import contextmanager
+import time
+
+PHASES = ("switching", "killing", "replication", "agent_set", "data_collection")
+EVENTS = ("births", "deaths", "blocked_replications", "switches", "mutations")
+
+
+class PhaseStats:
+    # Wall time per phase and event counts, for one step or accumulated over many.
+    #   switching        persister <-> replicating transitions
+    #   killing          kill-probability lookup and draw
+    #   replication      replication draw, mutation sampling, neighbour search
+    #   agent_set        adding/removing bacteria in the grid and AgentSet (numpy engine:
+    #                    compacting and growing the population arrays)
+    #   data_collection  DataCollector.collect
+    # blocked_replications counts replicating bacteria with no empty Moore neighbour.
+    __slots__ = ("seconds", "events")
+
+    def __init__(self):
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+        self.events = dict.fromkeys(EVENTS, 0)
+
+    def merge(self, other):
+        for phase, seconds in other.seconds.items():
+            self.seconds[phase] += seconds
+        for event, count in other.events.items():
+            self.events[event] += count
+
+    def as_dict(self):
+        return {"seconds": dict(self.seconds), "events": dict(self.events)}
+
+
+class StepProfiler:
+    def __init__(self):
+        self.current = PhaseStats()
+        self.total = PhaseStats()
+        self.steps = []
+
+    @contextmanager
+    def phase(self, name):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.current.seconds[name] += time.perf_counter() - t0
+
+    def start_step(self):
+        self.current = PhaseStats()
+
+    def end_step(self):
+        self.total.merge(self.current)
+        self.steps.append(self.current)
+
+    def report(self):
+        total_seconds = sum(self.total.seconds.values())
+        lines = [f"Phase breakdown over {len(self.steps)} step(s), {total_seconds:.3f}s profiled:"]
+        for phase in PHASES:
+            seconds = self.total.seconds[phase]
+            share = seconds / total_seconds if total_seconds else 0.0
+            lines.append(f"  {phase:<22}{seconds:>10.3f}s {share:>7.1%}")
+        lines.append("Events:")
+        for event in EVENTS:
+            lines.append(f"  {event:<22}{self.total.events[event]:>10}")
+        return "\n".join(lines)
+
+
+def profiled_agent_step(agent, profiler):
+    # MtbBacterium.step with each phase timed; makes the same random draws as step().
+    clock = time.perf_counter
+    seconds = profiler.current.seconds
+    events = profiler.current.events
+
+    t0 = clock()
+    switched = agent.switch_phenotype()
+    t1 = clock()
+    seconds["switching"] += t1 - t0
+    events["switches"] += switched
+
+    killed = agent.is_killed()
+    t2 = clock()
+    seconds["killing"] += t2 - t1
+    if killed:
+        agent.remove()
+        seconds["agent_set"] += clock() - t2
+        events["deaths"] += 1
+        return
+
+    if not agent.is_persister and agent.pos not in agent.model.grid.frontier:
+        events["blocked_replications"] += 1
+    t2 = clock()
+    spawned = agent.spawn_child()
+    t3 = clock()
+    seconds["replication"] += t3 - t2
+    if spawned is not None:
+        child, new_pos = spawned
+        agent.add_child(child, new_pos)
+        seconds["agent_set"] += clock() - t3
+        events["births"] += 1
+        events["mutations"] += child.resistance_mask != agent.resistance_mask
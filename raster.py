@@ -0,0 +1,80 @@
+from counters import N_PATTERNS
+from pharmacodynamics import DRUG_BITS
+import numpy as np
+
+# Cell categories of the raster view, in the order of RASTER_COLORS. A bacterium takes
+# the colour of the last drug (in RIF, INH, PZA, EMB order) it is resistant to, then
+# persister, then plain susceptible, the same precedence as mtb_potrayal in app_viz.py.
+EMPTY, SUSCEPTIBLE, PERSISTER, RES_RIF, RES_INH, RES_PZA, RES_EMB = range(7)
+RASTER_COLORS = ("#FFFFFF", "tab:red", "#8B0000", "#D4FF00", "#37FF00", "#0044FF", "#FF00D9")
+
+
+def _pattern_categories():
+    categories = np.empty(N_PATTERNS, dtype=np.uint8)
+    for key in range(N_PATTERNS):
+        mask, is_persister = key >> 1, key & 1
+        category = PERSISTER if is_persister else SUSCEPTIBLE
+        for drug, resistant_category in (("RIF", RES_RIF), ("INH", RES_INH), ("PZA", RES_PZA), ("EMB", RES_EMB)):
+            if mask & DRUG_BITS[drug]:
+                category = resistant_category
+        categories[key] = category
+    return categories
+
+
+# Category of every PopulationCounts pattern key (resistance_mask << 1 | is_persister).
+PATTERN_CATEGORIES = _pattern_categories()
+
+
+def category_array(model):
+    # (height, width) uint8 array of cell categories, row y and column x, so it can be
+    # shown directly as an image with origin="lower".
+    x, y, is_persister, resistance = model.get_population_arrays()
+    categories = np.zeros((model.height, model.width), dtype=np.uint8)
+    keys = (resistance.astype(np.intp) << 1) | is_persister
+    categories[y, x] = PATTERN_CATEGORIES[keys]
+    return categories
+
+
+# Category of every cell code of a history.py frame (0 empty, else 1 + pattern key).
+CELL_CODE_CATEGORIES = np.concatenate(([EMPTY], PATTERN_CATEGORIES)).astype(np.uint8)
+
+
+def frame_categories(frame):
+    # Category array, laid out like category_array, of a recorded history frame.
+    return CELL_CODE_CATEGORIES[frame.T]
+
+
+class RasterState:
+    # RGBA image of the grid that is kept between frames. update() recomputes the cell
+    # categories and rewrites only the pixels whose category changed since the last frame.
+    def __init__(self, width, height, colors=RASTER_COLORS):
+        from matplotlib.colors import to_rgba_array
+
+        self.palette = (to_rgba_array(colors) * 255).round().astype(np.uint8)
+        self.categories = np.zeros((height, width), dtype=np.uint8)
+        self.rgba = np.empty((height, width, 4), dtype=np.uint8)
+        self.rgba[:] = self.palette[EMPTY]
+        self.step = None
+        self.n_changed = 0
+
+    def update(self, model):
+        categories = category_array(model)
+        changed = np.flatnonzero(categories != self.categories)
+        self.rgba.reshape(-1, 4)[changed] = self.palette[categories.ravel()[changed]]
+        self.categories = categories
+        self.step = model.steps
+        self.n_changed = len(changed)
+        return changed
+
+
+def downsample_categories(categories, max_size):
+    # Shrinks a category array so neither side exceeds max_size, keeping the highest
+    # category in each block so that rare resistant cells stay visible.
+    factor = -(-max(categories.shape) // max_size)
+    if factor <= 1:
+        return categories
+    height, width = categories.shape
+    padded = np.zeros((-(-height // factor) * factor, -(-width // factor) * factor), dtype=categories.dtype)
+    padded[:height, :width] = categories
+    blocks = padded.reshape(padded.shape[0] // factor, factor, padded.shape[1] // factor, factor)
+    return blocks.max(axis=(1, 3))
@@ -0,0 +1,136 @@
+from functools import lru_cache
+import hashlib
+import json
+import os
+
+# Modules whose source decides what a run produces; editing any of them changes every key.
+SIMULATION_MODULES = ("model", "agents", "numpy_engine", "counters", "mutation", "pharmacodynamics",
+                      "pharmacokinetics", "frontier_grid", "seeding", "streams", "tiled_engine",
+                      "fast_forward")
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "mtb-simulation")
+DEFAULT_MAX_BYTES = 256 * 2**20
+
+
+@lru_cache(maxsize=1)
+def code_version():
+    here = os.path.dirname(os.path.abspath(__file__))
+    digest = hashlib.sha256()
+    for name in SIMULATION_MODULES:
+        with open(os.path.join(here, f"{name}.py"), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+def model_parameters(model):
+    # Everything that decides how a freshly built (or restored) model evolves: grid,
+    # engine, tiling and fast-forward blocks, seed, every rate, PD constant and schedule
+    # attribute, and digests of the starting population and random-number state (which
+    # cover initial_mtb, the seeding layout and a resumed snapshot's position in its
+    # streams).
+    from model import SNAPSHOT_ATTRIBUTES
+
+    population = hashlib.sha256()
+    for array in model.get_population_arrays():
+        population.update(array.tobytes())
+    random_version, random_internal, random_gauss = model.random.getstate()
+    random_state = json.dumps([random_version, list(random_internal), random_gauss,
+                               model.random_stream.get_state(), model.mutation_sampler.get_state()])
+    return {
+        "engine": model.engine,
+        "tiles": model.tiles,
+        "fast_forward_block": model.fast_forward_block,
+        "width": model.width,
+        "height": model.height,
+        "seed": model.seed,
+        "steps": model.steps,
+        "attributes": {name: getattr(model, name) for name in SNAPSHOT_ATTRIBUTES},
+        "population": population.hexdigest(),
+        "random_state": hashlib.sha256(random_state.encode()).hexdigest(),
+    }
+
+
+def result_key(model, days):
+    # Content address of running `model` up to day `days` with the current code.
+    payload = json.dumps({"code_version": code_version(), "days": days, "parameters": model_parameters(model)},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResultCache:
+    # One JSON file per result in `directory`, named by its key. Reading a result touches
+    # its modification time, and writing one evicts the least recently used files until
+    # the directory is within max_bytes. Files are written under a temporary name and
+    # renamed, so parallel sweep workers can share a cache.
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                result = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return result
+
+    def put(self, key, result):
+        path = self._path(key)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "w") as f:
+            json.dump(result, f)
+        os.replace(temporary, path)
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".json"):
+                os.remove(entry.path)
+
+
+def run_cached(model, days, cache):
+    # Steps model up to day `days` unless the cache already has that result. Returns
+    # (result, hit) where result is {"days", "model_vars", "histogram"}: the reporter
+    # series and the final PopulationCounts histogram. On a hit the model is not stepped.
+    if model.seed is None:
+        key = None
+    else:
+        key = result_key(model, days)
+        result = cache.get(key)
+        if result is not None:
+            return result, True
+    while model.steps < days:
+        model.step()
+    result = model_result(model)
+    if key is not None:
+        cache.put(key, result)
+    return result, False
+
+
+def model_result(model):
+    return {
+        "days": model.steps,
+        "model_vars": {name: list(values) for name, values in model.datacollector.model_vars.items()},
+        "histogram": list(model.counts.histogram),
+    }
@@ -0,0 +1,44 @@
+import numpy as np
+
+SEEDING_LAYOUTS = ("uniform", "focus", "foci")
+
+
+def _log_focus_weights(width, height, centers, radius):
+    xs = np.arange(width, dtype=np.float64)[:, None]
+    ys = np.arange(height, dtype=np.float64)[None, :]
+    log_weights = None
+    for cx, cy in centers:
+        log_w = -((xs - cx) ** 2 + (ys - cy) ** 2) / (2.0 * radius * radius)
+        log_weights = log_w if log_weights is None else np.logaddexp(log_weights, log_w)
+    return log_weights.ravel()
+
+
+def sample_initial_cells(rng, width, height, n, layout="uniform", n_foci=3, focus_radius=None):
+    # Returns n distinct flat cell indices (x * height + y), drawn in one pass.
+    #   uniform: every cell equally likely
+    #   focus:   Gaussian cluster around the grid centre
+    #   foci:    n_foci Gaussian clusters (granulomas) at random centres
+    n_cells = width * height
+    if layout not in SEEDING_LAYOUTS:
+        raise ValueError(f"Unknown seeding layout '{layout}', expected one of {SEEDING_LAYOUTS}.")
+    if n > n_cells:
+        raise ValueError(f"Cannot place {n} bacteria on a {width}x{height} grid.")
+
+    if layout == "uniform":
+        return rng.choice(n_cells, size=n, replace=False)
+
+    if layout == "focus":
+        centers = [((width - 1) / 2.0, (height - 1) / 2.0)]
+    else:
+        centers = list(zip(rng.uniform(0, width - 1, n_foci), rng.uniform(0, height - 1, n_foci)))
+
+    if focus_radius is None:
+        # Half the radius of a disc holding each cluster's share of the inoculum,
+        # so most of a cluster lands inside that disc.
+        focus_radius = max(1.0, np.sqrt(n / len(centers) / np.pi) / 2.0)
+
+    # Gumbel top-k: sampling without replacement proportional to the focus weights.
+    keys = _log_focus_weights(width, height, centers, float(focus_radius)) + rng.gumbel(size=n_cells)
+    if n == n_cells:
+        return np.argsort(-keys)
+    return np.argpartition(-keys, n)[:n]
@@ -0,0 +1,62 @@
+import numpy as np
+import itertools
+
+BLOCK_SIZE = 8192
+
+
+class RandomStream:
+    # Model-level source of randomness. random() serves uniform [0, 1) draws out of blocks
+    # that the numpy generator fills block_size at a time; it is the __next__ of an
+    # itertools.chain over those blocks, so a scalar draw costs no more than
+    # random.Random.random. Vectorized code draws from .generator directly.
+    #
+    # Streams split reproducibly: spawn(n) and child(key) derive independent streams from
+    # this one's SeedSequence, so per-run or per-worker streams depend only on the root
+    # seed and their key, never on which process runs them or in what order.
+    def __init__(self, seed=None, block_size=BLOCK_SIZE):
+        if isinstance(seed, np.random.SeedSequence):
+            self.seed_sequence = seed
+        else:
+            self.seed_sequence = np.random.SeedSequence(seed)
+        self.generator = np.random.Generator(np.random.PCG64(self.seed_sequence))
+        self.block_size = block_size
+        self._reset()
+
+    def _reset(self):
+        self._block_state = None
+        self._block = iter(())
+        self.random = itertools.chain.from_iterable(self._blocks()).__next__
+
+    def _blocks(self):
+        while True:
+            self._block_state = self.generator.bit_generator.state
+            self._block = iter(self.generator.random(self.block_size).tolist())
+            yield self._block
+
+    def spawn(self, n):
+        return [RandomStream(child, self.block_size) for child in self.seed_sequence.spawn(n)]
+
+    def child(self, *key):
+        # The stream spawn() would give at these positions, e.g. child(run_index) or
+        # child(config_id, seed), without spawning all the ones before it.
+        sequence = np.random.SeedSequence(self.seed_sequence.entropy,
+                                          spawn_key=self.seed_sequence.spawn_key + tuple(key))
+        return RandomStream(sequence, self.block_size)
+
+    def get_state(self):
+        # The generator state at the start of the current block, how much of that block has
+        # been served, and the generator state now (vectorized draws since the block).
+        return {
+            "block_state": self._block_state,
+            "served": self.block_size - self._block.__length_hint__() if self._block_state else 0,
+            "generator_state": self.generator.bit_generator.state,
+        }
+
+    def set_state(self, state):
+        self._reset()
+        if state["block_state"] is not None:
+            self.generator.bit_generator.state = state["block_state"]
+            self.random()
+            for _ in range(state["served"] - 1):
+                self.random()
+        self.generator.bit_generator.state = state["generator_state"]
@@ -0,0 +1,194 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from model import MtbResistanceModel
+from streams import RandomStream
+from result_cache import ResultCache, model_result, run_cached
+from pharmacodynamics import DRUGS
+import pandas as pd
+import itertools
+import argparse
+import os
+
+REPORTERS = ["Total Mtb", "Susceptible", "Persister"] + [f"Res-{drug}" for drug in DRUGS]
+QUANTILES = (0.05, 0.5, 0.95)
+
+
+def expand_grid(param_grid):
+    # {"day_start": [7, 21], "drug_type": ["RIF", "RIF INH"]} -> list of 4 configs.
+    # A list of dicts is passed through unchanged.
+    if isinstance(param_grid, dict):
+        names = list(param_grid)
+        values = [v if isinstance(v, (list, tuple)) else [v] for v in param_grid.values()]
+        return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+    return [dict(config) for config in param_grid]
+
+
+def run_single(config_id, config, seed, days, root_seed=None, cache_dir=None):
+    # With a root_seed, run `seed` uses child stream `seed` of the root stream instead of
+    # the plain integer seed, so a whole sweep is reproduced from one number.
+    model_seed = seed if root_seed is None else RandomStream(root_seed).child(seed).seed_sequence
+    model = MtbResistanceModel(seed=model_seed, **config)
+    if cache_dir:
+        result, _ = run_cached(model, days, ResultCache(cache_dir))
+    else:
+        for _ in range(days):
+            model.step()
+        result = model_result(model)
+    series = pd.DataFrame(result["model_vars"])
+    series.index.name = "day"
+    series = series.reset_index()
+    series.insert(0, "seed", seed)
+    series.insert(0, "config_id", config_id)
+    for name, value in config.items():
+        series[name] = value
+    return series
+
+
+def first_resistance_days(results):
+    # Day on which each run first has a bacterium resistant to each drug (NaN if never).
+    rows = []
+    for (config_id, seed), run in results.groupby(["config_id", "seed"], sort=True):
+        row = {"config_id": config_id, "seed": seed}
+        for drug in DRUGS:
+            resistant_days = run.loc[run[f"Res-{drug}"] > 0, "day"]
+            row[f"first-{drug}"] = resistant_days.min() if len(resistant_days) else float("nan")
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+
+def summarize(results, configs):
+    grouped = results.groupby(["config_id", "day"])[REPORTERS]
+    bands = [grouped.mean().add_suffix(" mean")]
+    for q in QUANTILES:
+        bands.append(grouped.quantile(q).add_suffix(f" q{int(q * 100):02d}"))
+    bands = pd.concat(bands, axis=1).reset_index()
+
+    first = first_resistance_days(results)
+    first_columns = [f"first-{drug}" for drug in DRUGS]
+    first_grouped = first.groupby("config_id")[first_columns]
+    resistance = pd.concat([
+        first_grouped.median().add_suffix(" median"),
+        first_grouped.mean().add_suffix(" mean"),
+        first_grouped.count().div(first.groupby("config_id").size(), axis=0).add_suffix(" fraction"),
+    ], axis=1).reset_index()
+
+    config_table = pd.DataFrame(configs)
+    config_table.insert(0, "config_id", range(len(configs)))
+    return bands.merge(config_table, on="config_id"), resistance.merge(config_table, on="config_id")
+
+
+def run_sweep(param_grid, seeds=(0,), days=180, workers=None, output=None, root_seed=None, cache_dir=None):
+    # Runs every (config, seed) pair on a process pool. Each run is seeded only by its own
+    # seed, so results do not depend on the worker count or completion order.
+    # Returns (results, bands, resistance): the per-day reporter series of every run,
+    # per-config mean/quantile bands, and time-to-first-resistance statistics.
+    configs = expand_grid(param_grid)
+    jobs = [(config_id, config, seed) for config_id, config in enumerate(configs) for seed in seeds]
+    workers = workers or os.cpu_count()
+
+    if output and os.path.exists(output):
+        os.remove(output)
+
+    runs = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_single, config_id, config, seed, days, root_seed, cache_dir) for config_id, config, seed in jobs]
+        for future in as_completed(futures):
+            series = future.result()
+            runs.append(series)
+            if output:
+                series.to_csv(output, mode="a", header=not os.path.exists(output), index=False)
+
+    results = pd.concat(runs).sort_values(["config_id", "seed", "day"]).reset_index(drop=True)
+
+    bands, resistance = summarize(results, configs)
+    return results, bands, resistance
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description='Mtb parameter sweep')
+
+    parser.add_argument('--start', type=int, nargs='+', required=True,
+                        help='Treatment start day(s)')
+
+    parser.add_argument('--interval', type=int, nargs='+', default=[1],
+                        help='Treatment interval(s) (default: 1)')
+
+    parser.add_argument('--drug-type', type=str, nargs='+', default=["RIF PZA INH EMB"],
+                        help='Drug regimen(s), each a space-separated string (default: "RIF PZA INH EMB")')
+
+    parser.add_argument('--pk', action='store_true',
+                        help='Time-varying drug concentrations from dose absorption/elimination instead of on/off days')
+
+    parser.add_argument('--adherence', type=float, nargs='+', default=[1.0],
+                        help='With --pk, fraction(s) of scheduled doses taken (default: 1.0)')
+
+    parser.add_argument('--fast-forward', action='store_true',
+                        help='Run the untreated days before treatment on per-block counts instead of bacteria')
+
+    parser.add_argument('--days', type=int, required=True,
+                        help='Number of days')
+
+    parser.add_argument('--seeds', type=int, default=10,
+                        help='Number of seeds per configuration, 0..N-1 (default: 10)')
+
+    parser.add_argument('--root-seed', type=int, default=None,
+                        help='Derive every run\'s random stream from this seed instead of using the seed index directly')
+
+    parser.add_argument('--initial', type=int, nargs='+', default=[200],
+                        help='Initial population(s) (default: 200)')
+
+    parser.add_argument('--width', type=int, nargs='+', default=[250],
+                        help='Grid width(s) (default: 250)')
+
+    parser.add_argument('--height', type=int, nargs='+', default=[250],
+                        help='Grid height(s) (default: 250)')
+
+    parser.add_argument('--engine', type=str, default="agent", choices=["agent", "numpy", "tiled"],
+                        help='Simulation engine (default: agent)')
+
+    parser.add_argument('--workers', type=int, default=None,
+                        help='Worker processes (default: all cores)')
+
+    parser.add_argument('--cache', type=str, default=None,
+                        help='Result cache directory; runs already in it are not simulated again')
+
+    parser.add_argument('--output', type=str, default="sweep_results.csv",
+                        help='Per-run time series, streamed as runs finish (default: sweep_results.csv)')
+
+    parser.add_argument('--summary', type=str, default="sweep_summary.csv",
+                        help='Per-condition mean/quantile bands (default: sweep_summary.csv)')
+
+    parser.add_argument('--resistance', type=str, default="sweep_resistance.csv",
+                        help='Time-to-first-resistance statistics (default: sweep_resistance.csv)')
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    param_grid = {
+        "day_start": args.start,
+        "day_interval": args.interval,
+        "drug_type": args.drug_type,
+        "initial_mtb": args.initial,
+        "width": args.width,
+        "height": args.height,
+        "engine": [args.engine],
+    }
+    if args.pk:
+        param_grid["pk"] = [True]
+        param_grid["adherence"] = args.adherence
+    if args.fast_forward:
+        param_grid["fast_forward"] = [True]
+    n_configs = len(expand_grid(param_grid))
+    print(f"Running {n_configs} configuration(s) x {args.seeds} seed(s) for {args.days} days "
+          f"on {args.workers or os.cpu_count()} worker(s).")
+
+    results, bands, resistance = run_sweep(param_grid, seeds=range(args.seeds), days=args.days,
+                                           workers=args.workers, output=args.output, root_seed=args.root_seed,
+                                           cache_dir=args.cache)
+    bands.to_csv(args.summary, index=False)
+    resistance.to_csv(args.resistance, index=False)
+
+    print(f"Per-run series: {args.output}")
+    print(f"Per-condition bands: {args.summary}")
+    print(f"Time to first resistance: {args.resistance}")
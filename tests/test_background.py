@@ -0,0 +1,13 @@
+from background import FINISHED, BackgroundRunner
+
+
+def test_rows_start_with_the_inoculum():
+    params = dict(seed=2, engine="numpy", width=40, height=40, initial_mtb=50)
+    runner = BackgroundRunner(params, days=5, max_fps=0)
+    runner.start()
+    runner.join(timeout=120)
+
+    assert runner.state == FINISHED
+    first, rows = runner.rows_since(0)
+    assert first == 0 and len(rows) == 6
+    assert rows[0]["Total Mtb"] == 50
@@ -0,0 +1,50 @@
+from fast_forward import compare_with_agent_runs
+from model import MtbResistanceModel
+import numpy as np
+import pytest
+
+SEEDS = range(3)
+
+
+def mean_totals(days, fast_forward, **params):
+    totals = []
+    for seed in SEEDS:
+        model = MtbResistanceModel(seed=100 + seed, engine="numpy", fast_forward=fast_forward, day_start=1000,
+                                   **params)
+        for _ in range(days):
+            model.step()
+        totals.append(model.datacollector.model_vars["Total Mtb"])
+    return np.mean(totals, axis=0)
+
+
+@pytest.mark.parametrize("seeding", ["uniform", "focus", "foci"])
+def test_untreated_growth_matches_full_runs(seeding):
+    # On a grid that is still mostly empty, where the frontier estimate matters most.
+    params = dict(width=400, height=400, initial_mtb=200, seeding=seeding)
+    ratio = mean_totals(20, True, **params) / mean_totals(20, False, **params)
+    for day in (5, 10, 15, 20):
+        assert abs(ratio[day] - 1) < 0.1, f"day {day}: fast-forwarded/full total = {ratio[day]:.3f}"
+
+
+def test_runs_through_treatment_match_agent_runs():
+    params = dict(width=100, height=100, initial_mtb=150, day_start=15, drug_type="RIF INH")
+    comparison = compare_with_agent_runs(range(4), 25, **params)
+    fast, full, fast_sd, full_sd = comparison["Total Mtb"]
+    scale = np.maximum(np.maximum(fast_sd, full_sd), 0.05 * np.maximum(full, 1.0))
+    deviation = np.abs(fast - full) / scale
+    assert deviation.max() < 3, f"Total Mtb deviates by {deviation.max():.2f} on day {deviation.argmax()}"
+
+
+def test_resume_while_fast_forwarding(tmp_path):
+    params = dict(width=80, height=80, initial_mtb=100, day_start=12, drug_type="RIF INH", engine="numpy",
+                  fast_forward=True)
+    uninterrupted = MtbResistanceModel(seed=3, **params)
+    for _ in range(6):
+        uninterrupted.step()
+    path = tmp_path / "snapshot.npz"
+    uninterrupted.save_snapshot(path)
+    resumed = MtbResistanceModel.load_snapshot(path)
+    for _ in range(14):
+        uninterrupted.step()
+        resumed.step()
+    assert resumed.datacollector.model_vars == uninterrupted.datacollector.model_vars
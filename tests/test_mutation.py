@@ -0,0 +1,56 @@
+from mutation import MutationSampler
+from pharmacodynamics import DRUGS
+from streams import RandomStream
+from types import SimpleNamespace
+import math
+import random
+
+RATES = {"RIF": 3.3e-3, "INH": 3.2e-4, "PZA": 1e-2, "EMB": 6.4e-4}
+
+
+def sampler_model(seed=0):
+    return SimpleNamespace(random_stream=RandomStream(seed),
+                           **{f"{drug.lower()}_mutation_rate": rate for drug, rate in RATES.items()})
+
+
+def test_mutation_counts_match_independent_bernoulli_draws():
+    # Over many replications from a mix of parent masks, the mutations per drug must be
+    # Binomial(eligible replications, rate).
+    sampler = MutationSampler(sampler_model())
+    parent_rng = random.Random(1)
+
+    eligible = dict.fromkeys(DRUGS, 0)
+    mutated = dict.fromkeys(DRUGS, 0)
+    for _ in range(1_000_000):
+        parent_mask = 0 if parent_rng.random() < 0.8 else parent_rng.randrange(16)
+        child_mask = sampler.sample(parent_mask)
+        for i, drug in enumerate(DRUGS):
+            if not parent_mask & (1 << i):
+                eligible[drug] += 1
+                mutated[drug] += bool(child_mask & (1 << i))
+
+    for drug in DRUGS:
+        expected = eligible[drug] * RATES[drug]
+        z = (mutated[drug] - expected) / math.sqrt(expected * (1 - RATES[drug]))
+        assert abs(z) < 4, f"{drug}: {mutated[drug]} mutations, expected {expected:.1f} (z = {z:+.2f})"
+
+
+def test_children_keep_parent_resistance():
+    sampler = MutationSampler(sampler_model())
+    for parent_mask in range(16):
+        for _ in range(1000):
+            assert sampler.sample(parent_mask) & parent_mask == parent_mask
+
+
+def test_state_round_trip_reproduces_draws():
+    model = sampler_model(seed=5)
+    sampler = MutationSampler(model)
+    for _ in range(10_000):
+        sampler.sample(0)
+    state = sampler.get_state()
+    stream_state = model.random_stream.get_state()
+    expected = [sampler.sample(0) for _ in range(50_000)]
+
+    model.random_stream.set_state(stream_state)
+    sampler.set_state(state)
+    assert [sampler.sample(0) for _ in range(50_000)] == expected
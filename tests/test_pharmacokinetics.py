@@ -0,0 +1,19 @@
+from pharmacokinetics import doses_taken
+import numpy as np
+
+
+def test_forced_misses_drive_the_adherence_chain():
+    # With miss_persistence=1 a miss is always followed by another, and with adherence 0.5
+    # a taken dose is always followed by another taken dose: the first forced miss decides
+    # every later dose.
+    dose_days = list(range(10, 30))
+    taken = doses_taken(dose_days, adherence=0.5, miss_persistence=1.0, missed_doses=[15],
+                        rng=np.random.default_rng(0))
+    np.testing.assert_array_equal(taken, [day < 15 for day in dose_days])
+
+
+def test_forced_misses_keep_the_other_draws():
+    dose_days = list(range(40))
+    free = doses_taken(dose_days, 0.7, None, [], np.random.default_rng(3))
+    forced = doses_taken(dose_days, 0.7, None, [5, 6], np.random.default_rng(3))
+    np.testing.assert_array_equal(forced, free & ~np.isin(dose_days, [5, 6]))
@@ -0,0 +1,13 @@
+from model import MtbResistanceModel
+
+
+def test_profiled_agent_step_makes_the_same_draws_as_step():
+    # MtbBacterium.step inlines the phase methods that profiled_agent_step times.
+    params = dict(seed=4, engine="agent", width=60, height=60, initial_mtb=150, day_start=10, drug_type="RIF INH")
+    plain = MtbResistanceModel(**params)
+    profiled = MtbResistanceModel(profile=True, **params)
+    for _ in range(25):
+        plain.step()
+        profiled.step()
+    assert profiled.datacollector.model_vars == plain.datacollector.model_vars
+    assert profiled.profiler.total.events["births"] > 0
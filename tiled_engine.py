@@ -0,0 +1,528 @@
+from multiprocessing import shared_memory
+from counters import N_PATTERNS, PopulationCounts
+from numpy_engine import MOORE_DX, MOORE_DY, _untimed
+from pharmacodynamics import DRUGS
+from profiling import PHASES
+import multiprocessing
+import numpy as np
+import traceback
+import weakref
+import time
+
+# Shared per-cell arrays, all (width, height):
+#   cells        0 for an empty cell, otherwise 1 + (resistance_mask << 1 | is_persister)
+#   freed_at     update rank of the bacterium killed in the cell today, -1 if it was empty
+#                before today; a freed cell is only visible to parents with a higher rank
+#   parent_rank  update rank of a replicating parent
+#   child_code   cell code of that parent's (possibly mutated) child
+#   target       flat index of the cell a parent proposes to place its child in, or
+#                NO_PROPOSAL / WON / LOST once the tile owning that cell has resolved it
+#   clone        lineage clone id of the bacterium in the cell
+#   child_clone  clone id of a replicating parent's child, or MUTANT_CLONE until a mutant
+#                child's new clone is recorded
+SHARED_ARRAYS = (
+    ("cells", np.uint8),
+    ("freed_at", np.float64),
+    ("parent_rank", np.float64),
+    ("child_code", np.uint8),
+    ("target", np.int64),
+    ("clone", np.int32),
+    ("child_clone", np.int32),
+)
+NO_PROPOSAL, WON, LOST = -1, -2, -3
+MUTANT_CLONE = -1
+
+
+class WorkerFailure:
+    # Sent back by a worker process in place of a result when a command raised.
+    def __init__(self, traceback_text):
+        self.traceback = traceback_text
+
+
+def split_tiles(width, height, tiles_x, tiles_y):
+    # (x0, x1, y0, y1) of every tile, row-major over the tile grid.
+    xs = np.linspace(0, width, tiles_x + 1).astype(int)
+    ys = np.linspace(0, height, tiles_y + 1).astype(int)
+    return [(int(xs[i]), int(xs[i + 1]), int(ys[j]), int(ys[j + 1]))
+            for i in range(tiles_x) for j in range(tiles_y)]
+
+
+class Tile:
+    # One rectangular block of the grid. It only ever writes cells of its own block, plus
+    # the WON/LOST verdict in `target` of parents (possibly in a neighbouring tile) that
+    # proposed a cell in its block; it reads a one-cell halo around the block.
+    def __init__(self, index, bounds, arrays, width, height):
+        self.index = index
+        self.x0, self.x1, self.y0, self.y1 = bounds
+        self.arrays = arrays
+        self.width = width
+        self.height = height
+        self.rng = None
+        self.pending = np.empty(0, dtype=np.int64)
+
+    def draw(self, day_key, params, seconds):
+        # Switching, killing, the replication draw and mutation for every bacterium of the
+        # block, the same rules as NumpyPopulation. Returns the histogram change and events,
+        # and adds the time spent per profiler phase to `seconds`.
+        clock = time.perf_counter
+        self.rng = rng = np.random.Generator(np.random.PCG64(np.random.SeedSequence([day_key, self.index])))
+        arrays = self.arrays
+        block = arrays["cells"][self.x0:self.x1, self.y0:self.y1]
+        arrays["freed_at"][self.x0:self.x1, self.y0:self.y1] = -1.0
+        arrays["target"][self.x0:self.x1, self.y0:self.y1] = NO_PROPOSAL
+        self.pending = np.empty(0, dtype=np.int64)
+
+        lx, ly = np.nonzero(block)
+        delta = np.zeros(N_PATTERNS, dtype=np.int64)
+        events = {"switches": 0, "deaths": 0}
+        if lx.size == 0:
+            return delta, events
+
+        keys = block[lx, ly].astype(np.int64) - 1
+        delta -= np.bincount(keys, minlength=N_PATTERNS)
+        persister = (keys & 1).astype(bool)
+        resistance = keys >> 1
+        rank = rng.random(lx.size)
+
+        t0 = clock()
+        u = rng.random(lx.size)
+        if params["any_drug_on"]:
+            to_persister = ~persister & (u < params["prob_susceptible_to_persister"])
+            to_susceptible = persister & (u < params["prob_persister_to_susceptible_drug_on"])
+        else:
+            to_persister = np.zeros_like(persister)
+            to_susceptible = persister & (u < params["prob_persister_to_susceptible_no_drug"])
+        switched = to_persister | to_susceptible
+        persister ^= switched
+        events["switches"] = int(np.count_nonzero(switched))
+        t1 = clock()
+        seconds["switching"] += t1 - t0
+
+        if params["any_drug_on"]:
+            kill_probability = np.asarray(params["kill_probability_today"])[resistance]
+            kill_probability[persister] = 0.0
+            killed = rng.random(lx.size) < kill_probability
+        else:
+            killed = np.zeros(lx.size, dtype=bool)
+        events["deaths"] = int(np.count_nonzero(killed))
+        t2 = clock()
+        seconds["killing"] += t2 - t1
+
+        keys = resistance << 1 | persister
+        block[lx, ly] = np.where(killed, 0, keys + 1)
+        arrays["freed_at"][self.x0 + lx[killed], self.y0 + ly[killed]] = rank[killed]
+        delta += np.bincount(keys[~killed], minlength=N_PATTERNS)
+        t3 = clock()
+        seconds["agent_set"] += t3 - t2
+
+        replicating = ~persister & ~killed & (rng.random(lx.size) < params["replication_prob_per_day"])
+        parents = np.flatnonzero(replicating)
+        if parents.size:
+            px = self.x0 + lx[parents]
+            py = self.y0 + ly[parents]
+            parent_resistance = resistance[parents]
+            child_resistance = parent_resistance.copy()
+            for i, rate in enumerate(params["mutation_rates"]):
+                bit = 1 << i
+                eligible = np.flatnonzero((parent_resistance & bit) == 0)
+                n_mutants = rng.binomial(eligible.size, rate) if eligible.size else 0
+                if n_mutants:
+                    child_resistance[rng.choice(eligible, size=n_mutants, replace=False)] |= bit
+            arrays["parent_rank"][px, py] = rank[parents]
+            arrays["child_code"][px, py] = (child_resistance << 1) + 1
+            arrays["child_clone"][px, py] = np.where(child_resistance != parent_resistance, MUTANT_CLONE,
+                                                     arrays["clone"][px, py])
+            self.pending = px * self.height + py
+        seconds["replication"] += clock() - t3
+        return delta, events
+
+    def count_blocked(self):
+        # Replicating bacteria of the block whose Moore neighbours are all occupied or
+        # off-grid, counted between draw and placement like NumpyPopulation does.
+        cells = self.arrays["cells"]
+        hx0, hx1 = max(self.x0 - 1, 0), min(self.x1 + 1, self.width)
+        hy0, hy1 = max(self.y0 - 1, 0), min(self.y1 + 1, self.height)
+        block_width, block_height = self.x1 - self.x0, self.y1 - self.y0
+        padded = np.ones((block_width + 2, block_height + 2), dtype=bool)
+        padded[hx0 - self.x0 + 1:hx1 - self.x0 + 1, hy0 - self.y0 + 1:hy1 - self.y0 + 1] = \
+            cells[hx0:hx1, hy0:hy1] != 0
+        empty_neighbors = sum(
+            ~padded[1 + dx:block_width + 1 + dx, 1 + dy:block_height + 1 + dy]
+            for dx, dy in zip(MOORE_DX.tolist(), MOORE_DY.tolist())
+        )
+        block = cells[self.x0:self.x1, self.y0:self.y1]
+        replicating = (block > 0) & (((block - 1) & 1) == 0)
+        return int(np.count_nonzero(replicating & (empty_neighbors == 0)))
+
+    def propose(self):
+        # Every pending parent picks one of its visible empty neighbours at random. Parents
+        # with none are dropped: cells only fill up during placement. Returns the number of
+        # proposals made.
+        arrays = self.arrays
+        target = arrays["target"].reshape(-1)
+        if self.pending.size:
+            verdict = target[self.pending]
+            self.pending = self.pending[verdict != WON]
+            target[self.pending] = NO_PROPOSAL
+        if self.pending.size == 0:
+            return 0
+
+        px, py = np.divmod(self.pending, self.height)
+        nx = px[:, None] + MOORE_DX
+        ny = py[:, None] + MOORE_DY
+        empty = (nx >= 0) & (nx < self.width) & (ny >= 0) & (ny < self.height)
+        empty[empty] = arrays["cells"][nx[empty], ny[empty]] == 0
+        later = np.broadcast_to(arrays["parent_rank"][px, py][:, None], nx.shape)
+        empty[empty] = arrays["freed_at"][nx[empty], ny[empty]] < later[empty]
+
+        n_empty = empty.sum(axis=1)
+        has_room = n_empty > 0
+        self.pending = self.pending[has_room]
+        if self.pending.size == 0:
+            return 0
+        nx, ny, empty, n_empty = nx[has_room], ny[has_room], empty[has_room], n_empty[has_room]
+
+        pick = (self.rng.random(self.pending.size) * n_empty).astype(np.int64)
+        column = np.argmax(np.cumsum(empty, axis=1) > pick[:, None], axis=1)
+        rows = np.arange(self.pending.size)
+        target[self.pending] = nx[rows, column] * self.height + ny[rows, column]
+        return int(self.pending.size)
+
+    def resolve(self, seconds):
+        # Places the lowest-ranked proposal for each cell of the block, looking at parents in
+        # the block and its halo. Returns the histogram change, events and the (parent,
+        # child) flat cells of placed mutants, and adds the time spent to `seconds`.
+        clock = time.perf_counter
+        t0 = clock()
+        arrays = self.arrays
+        delta = np.zeros(N_PATTERNS, dtype=np.int64)
+        events = {"births": 0, "mutations": 0}
+        mutants = (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+        hx0, hx1 = max(self.x0 - 1, 0), min(self.x1 + 1, self.width)
+        hy0, hy1 = max(self.y0 - 1, 0), min(self.y1 + 1, self.height)
+        halo_target = arrays["target"][hx0:hx1, hy0:hy1]
+        lx, ly = np.nonzero(halo_target >= 0)
+        if lx.size == 0:
+            seconds["replication"] += clock() - t0
+            return delta, events, mutants
+        px, py = hx0 + lx, hy0 + ly
+        tx, ty = np.divmod(halo_target[lx, ly], self.height)
+        mine = (tx >= self.x0) & (tx < self.x1) & (ty >= self.y0) & (ty < self.y1)
+        if not mine.any():
+            seconds["replication"] += clock() - t0
+            return delta, events, mutants
+        px, py, tx, ty = px[mine], py[mine], tx[mine], ty[mine]
+
+        cell = tx * self.height + ty
+        order = np.lexsort((px * self.height + py, arrays["parent_rank"][px, py], cell))
+        cell, px, py, tx, ty = cell[order], px[order], py[order], tx[order], ty[order]
+        won = np.ones(cell.size, dtype=bool)
+        won[1:] = cell[1:] != cell[:-1]
+        t1 = clock()
+        seconds["replication"] += t1 - t0
+
+        child_code = arrays["child_code"][px[won], py[won]]
+        arrays["cells"][tx[won], ty[won]] = child_code
+        child_clone = arrays["child_clone"][px[won], py[won]]
+        arrays["clone"][tx[won], ty[won]] = child_clone
+        arrays["target"][px, py] = np.where(won, WON, LOST)
+
+        child_keys = child_code.astype(np.int64) - 1
+        delta += np.bincount(child_keys, minlength=N_PATTERNS)
+        parent_keys = arrays["cells"][px[won], py[won]].astype(np.int64) - 1
+        events["births"] = int(won.sum())
+        events["mutations"] = int(np.count_nonzero((child_keys >> 1) != (parent_keys >> 1)))
+        mutant = child_clone == MUTANT_CLONE
+        mutants = ((px[won] * self.height + py[won])[mutant], (tx[won] * self.height + ty[won])[mutant])
+        seconds["agent_set"] += clock() - t1
+        return delta, events, mutants
+
+
+class TileWorker:
+    # Runs the phases of a set of tiles; used in-process or inside a worker process. draw,
+    # propose and resolve also return the seconds the tiles spent per profiler phase.
+    def __init__(self, shm_names, width, height, tile_bounds, tile_indices):
+        self._shms = [shared_memory.SharedMemory(name=name) for name in shm_names]
+        arrays = {name: np.ndarray((width, height), dtype=dtype, buffer=shm.buf)
+                  for (name, dtype), shm in zip(SHARED_ARRAYS, self._shms)}
+        self.tiles = [Tile(i, tile_bounds[i], arrays, width, height) for i in tile_indices]
+
+    def draw(self, day_key, params):
+        delta = np.zeros(N_PATTERNS, dtype=np.int64)
+        events = {"switches": 0, "deaths": 0}
+        seconds = dict.fromkeys(PHASES, 0.0)
+        for tile in self.tiles:
+            tile_delta, tile_events = tile.draw(day_key, params, seconds)
+            delta += tile_delta
+            for name, count in tile_events.items():
+                events[name] += count
+        return (delta, events), seconds
+
+    def count_blocked(self):
+        return sum(tile.count_blocked() for tile in self.tiles)
+
+    def propose(self):
+        t0 = time.perf_counter()
+        proposals = sum(tile.propose() for tile in self.tiles)
+        seconds = dict.fromkeys(PHASES, 0.0)
+        seconds["replication"] = time.perf_counter() - t0
+        return proposals, seconds
+
+    def resolve(self):
+        delta = np.zeros(N_PATTERNS, dtype=np.int64)
+        events = {"births": 0, "mutations": 0}
+        seconds = dict.fromkeys(PHASES, 0.0)
+        parents, children = [], []
+        for tile in self.tiles:
+            tile_delta, tile_events, (tile_parents, tile_children) = tile.resolve(seconds)
+            delta += tile_delta
+            for name, count in tile_events.items():
+                events[name] += count
+            parents.append(tile_parents)
+            children.append(tile_children)
+        return (delta, events, (np.concatenate(parents), np.concatenate(children))), seconds
+
+    def close(self):
+        self.tiles = []
+        for shm in self._shms:
+            shm.close()
+
+
+def _serve(connection, *worker_args):
+    worker = None
+    try:
+        worker = TileWorker(*worker_args)
+        while True:
+            command, args = connection.recv()
+            if command == "stop":
+                break
+            connection.send(getattr(worker, command)(*args))
+    except Exception:
+        # Reported to the parent, which shuts every worker down and raises.
+        try:
+            connection.send(WorkerFailure(traceback.format_exc()))
+        except (OSError, ValueError):
+            pass
+    finally:
+        if worker is not None:
+            worker.close()
+        connection.close()
+
+
+def _shutdown(connections, processes, shms):
+    for connection in connections:
+        try:
+            connection.send(("stop", ()))
+        except (OSError, ValueError):
+            pass
+    for process in processes:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+            process.join()
+    for shm in shms:
+        shm.close()
+        shm.unlink()
+
+
+class TiledPopulation:
+    # Population of MtbResistanceModel(engine="tiled"): the grid lives in shared memory,
+    # split into tiles_x x tiles_y tiles, and `workers` processes step the tiles in
+    # parallel (0 runs them in this process). Each day is a sequence of phases with a
+    # barrier between them: draw (every tile on its own block), then rounds of propose
+    # (parents pick an empty neighbour, possibly across a tile border) and resolve (the
+    # tile owning a cell picks the lowest-ranked proposal for it) until no parent has a
+    # cell left to try.
+    #
+    # Each tile draws from its own generator, seeded from a per-day key taken from the
+    # model's random stream and the tile index. Results therefore depend on the seed and
+    # tiling but not on the number of workers.
+    def __init__(self, model, width, height, tiles=4, workers=0):
+        self.model = model
+        self.width = int(width)
+        self.height = int(height)
+        tiles_x, tiles_y = (tiles, tiles) if isinstance(tiles, int) else tiles
+        self.tile_bounds = split_tiles(self.width, self.height, tiles_x, tiles_y)
+        self.workers = int(workers)
+
+        n_cells = self.width * self.height
+        self._shms = [shared_memory.SharedMemory(create=True, size=max(n_cells * np.dtype(dtype).itemsize, 1))
+                      for _, dtype in SHARED_ARRAYS]
+        self.arrays = {name: np.ndarray((self.width, self.height), dtype=dtype, buffer=shm.buf)
+                       for (name, dtype), shm in zip(SHARED_ARRAYS, self._shms)}
+        self.arrays["cells"][:] = 0
+        shm_names = [shm.name for shm in self._shms]
+
+        self._connections = []
+        self._processes = []
+        self._local = None
+        self._finalizer = weakref.finalize(self, _shutdown, self._connections, self._processes, self._shms)
+        if self.workers:
+            context = multiprocessing.get_context("spawn")
+            n_tiles = len(self.tile_bounds)
+            for w in range(min(self.workers, n_tiles)):
+                connection, worker_connection = context.Pipe()
+                process = context.Process(
+                    target=_serve,
+                    args=(worker_connection, shm_names, self.width, self.height, self.tile_bounds,
+                          list(range(w, n_tiles, self.workers))),
+                    daemon=True,
+                )
+                try:
+                    process.start()
+                except Exception as exc:
+                    self.close()
+                    raise RuntimeError(f"Could not start tiled engine worker {w}: {exc!r}. "
+                                       "Its shared memory was released.") from exc
+                self._connections.append(connection)
+                self._processes.append(process)
+        else:
+            self._local = TileWorker(shm_names, self.width, self.height, self.tile_bounds,
+                                     list(range(len(self.tile_bounds))))
+
+    def close(self):
+        if self._local is not None:
+            self._local.close()
+            self._local = None
+        self.arrays = {}
+        self._finalizer()
+
+    def _run(self, command, *args):
+        if self._local is not None:
+            return [getattr(self._local, command)(*args)]
+        try:
+            for connection in self._connections:
+                connection.send((command, args))
+            results = [connection.recv() for connection in self._connections]
+        except (EOFError, OSError) as exc:
+            self._fail(command, f"lost the connection to a worker ({exc!r})")
+        for result in results:
+            if isinstance(result, WorkerFailure):
+                self._fail(command, f"a worker raised:\n{result.traceback}")
+        return results
+
+    def _fail(self, command, reason):
+        # Stops every worker, frees the shared memory and raises.
+        self.close()
+        exit_codes = [process.exitcode for process in self._processes]
+        raise RuntimeError(f"Tiled engine failed during '{command}': {reason}. "
+                           f"Worker exit codes: {exit_codes}; the shared memory was released.")
+
+    def _run_timed(self, command, *args):
+        # _run for a command whose workers also return their seconds per profiler phase.
+        # The wall time of the call is split over the phases in proportion to the time
+        # the workers reported, so profiles stay comparable with the other engines.
+        profiler = self.model.profiler
+        t0 = time.perf_counter()
+        replies = self._run(command, *args)
+        if profiler is not None:
+            wall = time.perf_counter() - t0
+            reported = dict.fromkeys(PHASES, 0.0)
+            for _, seconds in replies:
+                for phase, phase_seconds in seconds.items():
+                    reported[phase] += phase_seconds
+            total = sum(reported.values())
+            for phase, phase_seconds in reported.items():
+                share = phase_seconds / total if total else float(phase == "replication")
+                profiler.current.seconds[phase] += wall * share
+        return [result for result, _ in replies]
+
+    def __len__(self):
+        return int(np.count_nonzero(self.arrays["cells"]))
+
+    @property
+    def x(self):
+        return np.nonzero(self.arrays["cells"])[0].astype(np.int32)
+
+    @property
+    def y(self):
+        return np.nonzero(self.arrays["cells"])[1].astype(np.int32)
+
+    @property
+    def is_persister(self):
+        codes = self.arrays["cells"][self.arrays["cells"] > 0]
+        return ((codes - 1) & 1).astype(bool)
+
+    @property
+    def resistance(self):
+        codes = self.arrays["cells"][self.arrays["cells"] > 0]
+        return ((codes - 1) >> 1).astype(np.uint8)
+
+    @property
+    def clone(self):
+        return self.arrays["clone"][self.arrays["cells"] > 0]
+
+    def seed(self, cells, initial_persister_fraction):
+        is_persister = self.model.random_stream.generator.random(cells.size) < initial_persister_fraction
+        x, y = np.divmod(cells, self.height)
+        self.restore(x, y, is_persister, np.zeros(cells.size, dtype=np.uint8))
+
+    def restore(self, x, y, is_persister, resistance, clone=None):
+        keys = np.asarray(resistance, dtype=np.int64) << 1 | np.asarray(is_persister, dtype=bool)
+        self.arrays["cells"][:] = 0
+        self.arrays["cells"][np.asarray(x), np.asarray(y)] = keys + 1
+        self.arrays["clone"][:] = 0
+        if clone is not None:
+            self.arrays["clone"][np.asarray(x), np.asarray(y)] = clone
+        self.model.counts.apply(np.bincount(keys, minlength=N_PATTERNS))
+
+    def recount(self):
+        codes = self.arrays["cells"][self.arrays["cells"] > 0].astype(np.int64)
+        return PopulationCounts(np.bincount(codes - 1, minlength=N_PATTERNS).tolist())
+
+    def _record_mutants(self, parents, children):
+        # New lineage clones for the placed mutant children (flat cells) of `parents`, in
+        # parent cell order so clone ids do not depend on the number of workers.
+        if parents.size == 0:
+            return
+        order = np.argsort(parents)
+        px, py = np.divmod(parents[order], self.height)
+        cx, cy = np.divmod(children[order], self.height)
+        arrays = self.arrays
+        parent_mask = (arrays["cells"][px, py] - 1) >> 1
+        child_mask = (arrays["cells"][cx, cy] - 1) >> 1
+        if self.model.lineage is None:
+            arrays["clone"][cx, cy] = arrays["clone"][px, py]
+            return
+        arrays["clone"][cx, cy] = self.model.lineage.record_many(
+            arrays["clone"][px, py], parent_mask, child_mask, self.model.steps)
+
+    def step(self):
+        model = self.model
+        profiler = model.profiler
+
+        params = {
+            "any_drug_on": bool(model.active_drug_mask),
+            "kill_probability_today": list(model.kill_probability_today),
+            "prob_susceptible_to_persister": model.prob_susceptible_to_persister,
+            "prob_persister_to_susceptible_drug_on": model.prob_persister_to_susceptible_drug_on,
+            "prob_persister_to_susceptible_no_drug": model.prob_persister_to_susceptible_no_drug,
+            "replication_prob_per_day": model.replication_prob_per_day,
+            "mutation_rates": [getattr(model, f"{drug.lower()}_mutation_rate") for drug in DRUGS],
+        }
+        day_key = int(model.random_stream.generator.integers(2**63))
+
+        events = {"switches": 0, "deaths": 0, "births": 0, "mutations": 0}
+        for delta, worker_events in self._run_timed("draw", day_key, params):
+            model.counts.apply(delta)
+            for name, count in worker_events.items():
+                events[name] += count
+        if profiler is not None:
+            events["blocked_replications"] = sum(self._run("count_blocked"))
+        mutant_parents, mutant_children = [], []
+        while sum(self._run_timed("propose")):
+            for delta, worker_events, (parents, children) in self._run_timed("resolve"):
+                model.counts.apply(delta)
+                for name, count in worker_events.items():
+                    events[name] += count
+                mutant_parents.append(parents)
+                mutant_children.append(children)
+        if mutant_parents:
+            phase = profiler.phase if profiler is not None else _untimed
+            with phase("agent_set"):
+                self._record_mutants(np.concatenate(mutant_parents), np.concatenate(mutant_children))
+
+        if profiler is not None:
+            for name, count in events.items():
+                profiler.current.events[name] += count